@@ -21,21 +21,32 @@
 
 from __future__ import annotations
 
-from typing import Optional, Union
+from contextlib import asynccontextmanager
+from typing import List, Optional, Union
 
-from fastapi import FastAPI, Query
+from fastapi import FastAPI, Header, Query
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from fastapi import Request
 import uvicorn
 
 import os
 import logging
+from werkzeug.exceptions import HTTPException
 
+from mt_query.config import AppConf
 from mt_query.router import endpoints
+from mt_query.router.common import accepts_encoding
+from mt_query.model.response import CompressionMiddleware, FastJSONResponse
+from mt_query.router.etag import Conditional, NotModified
+from mt_query.router.metrics import MetricsMiddleware
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 
 from mt_query.model.models import (
     Aggregate,
     Capability,
+    CapabilityBatch,
+    CapabilityBatchResult,
     CapabilityV2,
     Firmware,
     Identity,
@@ -59,22 +70,49 @@ if debug_flag:
     log_level = logging.DEBUG
 logging.getLogger("paramiko").setLevel(log_level)
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # config is read and background jobs are started here, they need the running event loop
+    endpoints.start()
+    yield
+    endpoints.shutdown()
+
+
 app = FastAPI(
     description='A microservice for querying Mikrotik router health information.',
     version='1.0.0',
     title='mt-query-ms',
-    root_path="/mtquery"
+    root_path="/mtquery",
+    lifespan=lifespan,
+    default_response_class=FastJSONResponse,
 )
+# large lease and fleet payloads are compressed for clients that accept it
+app.add_middleware(CompressionMiddleware, settings=lambda: AppConf.config('credentials').get('compression'))
+app.add_middleware(MetricsMiddleware)
 templates = Jinja2Templates(directory="mt_query/templates")
 
 
+@app.exception_handler(HTTPException)
+async def werkzeug_exception_handler(request: Request, exc: HTTPException):
+    # the router layer reports errors through werkzeug abort()
+    retry_after = getattr(exc, 'retry_after', None)
+    headers = {'Retry-After': str(retry_after)} if retry_after else None
+    return JSONResponse(status_code=exc.code, content={'detail': exc.description}, headers=headers)
+
+
+@app.exception_handler(NotModified)
+async def not_modified_handler(request: Request, exc: NotModified):
+    return Response(status_code=304, headers={'ETag': exc.etag})
+
+
 @app.post(
     '/api/router', response_model=None, responses={'201': {'model': Aggregate}}, tags=['v1']
 )
-def router_endpoints_get_aggregate_v1(
+async def router_endpoints_get_aggregate_v1(
         body: Capability = None,
 ) -> Union[None, Aggregate]:
-    return endpoints.get_aggregate_v1(body)
+    return FastJSONResponse(await endpoints.get_aggregate_v1(body))
 
 
 @app.post(
@@ -83,10 +121,10 @@ def router_endpoints_get_aggregate_v1(
     responses={'201': {'model': CapabilityV2}},
     tags=['v1'],
 )
-def router_endpoints_get_capability_v1(
+async def router_endpoints_get_capability_v1(
         body: Capability = None,
 ) -> Union[None, CapabilityV2]:
-    return endpoints.get_capability_v1(body)
+    return FastJSONResponse(await endpoints.get_capability_v1(body))
 
 
 @app.get(
@@ -95,15 +133,20 @@ def router_endpoints_get_capability_v1(
     responses={'201': {'model': Aggregate}},
     tags=['v2'],
 )
-def router_endpoints_get_aggregate(
+async def router_endpoints_get_aggregate(
         host: Optional[str] = None,
         show_default: Optional[bool] = Query(False, alias='showDefault'),
         show_disabled: Optional[bool] = Query(False, alias='showDisabled'),
+        max_age: Optional[int] = Query(None, alias='maxAge', ge=0),
+        fresh: Optional[bool] = False,
+        if_none_match: Optional[str] = Header(None),
 ) -> Union[None, Aggregate]:
     """
     Fetch all health information on a router
     """
-    return endpoints.get_aggregate(host, show_disabled, show_default)
+    conditional = Conditional(if_none_match)
+    aggregate = await endpoints.get_aggregate(host, show_disabled, show_default, max_age, fresh, conditional)
+    return FastJSONResponse(aggregate, headers=conditional.headers)
 
 
 @app.get(
@@ -112,15 +155,21 @@ def router_endpoints_get_aggregate(
     responses={'201': {'model': CapabilityV2}},
     tags=['v2'],
 )
-def router_endpoints_get_capability(
+async def router_endpoints_get_capability(
         host: Optional[str] = None,
         show_default: Optional[bool] = Query(False, alias='showDefault'),
         show_disabled: Optional[bool] = Query(False, alias='showDisabled'),
+        max_age: Optional[int] = Query(None, alias='maxAge', ge=0),
+        fresh: Optional[bool] = False,
+        if_none_match: Optional[str] = Header(None),
 ) -> Union[None, CapabilityV2]:
     """
     Fetch leases for router capabilities.
     """
-    return endpoints.get_capability(host, show_disabled, show_default)
+    conditional = Conditional(if_none_match)
+    capability = await endpoints.get_capability(host, show_disabled, show_default, max_age=max_age, fresh=fresh,
+                                                conditional=conditional)
+    return FastJSONResponse(capability, headers=conditional.headers)
 
 
 @app.get(
@@ -129,11 +178,18 @@ def router_endpoints_get_capability(
     responses={'201': {'model': Firmware}},
     tags=['v2'],
 )
-def router_endpoints_get_firmware(host: Optional[str] = None) -> Union[None, Firmware]:
+async def router_endpoints_get_firmware(
+        host: Optional[str] = None,
+        max_age: Optional[int] = Query(None, alias='maxAge', ge=0),
+        fresh: Optional[bool] = False,
+        if_none_match: Optional[str] = Header(None),
+) -> Union[None, Firmware]:
     """
     Fetch firmware information from router
     """
-    return endpoints.get_firmware(host)
+    conditional = Conditional(if_none_match)
+    firmware = await endpoints.get_firmware(host, max_age, fresh, conditional)
+    return FastJSONResponse(firmware, headers=conditional.headers)
 
 
 @app.get(
@@ -142,11 +198,18 @@ def router_endpoints_get_firmware(host: Optional[str] = None) -> Union[None, Fir
     responses={'201': {'model': Identity}},
     tags=['v2'],
 )
-def router_endpoints_get_identity(host: Optional[str] = None) -> Union[None, Identity]:
+async def router_endpoints_get_identity(
+        host: Optional[str] = None,
+        max_age: Optional[int] = Query(None, alias='maxAge', ge=0),
+        fresh: Optional[bool] = False,
+        if_none_match: Optional[str] = Header(None),
+) -> Union[None, Identity]:
     """
     Fetch system identity
     """
-    return endpoints.get_identity(host)
+    conditional = Conditional(if_none_match)
+    identity = await endpoints.get_identity(host, max_age, fresh, conditional)
+    return FastJSONResponse(identity, headers=conditional.headers)
 
 
 @app.get(
@@ -155,11 +218,18 @@ def router_endpoints_get_identity(host: Optional[str] = None) -> Union[None, Ide
     responses={'201': {'model': LeaseArray}},
     tags=['v2'],
 )
-def router_endpoints_get_leases(host: Optional[str] = None) -> Union[None, LeaseArray]:
+async def router_endpoints_get_leases(
+        host: Optional[str] = None,
+        max_age: Optional[int] = Query(None, alias='maxAge', ge=0),
+        fresh: Optional[bool] = False,
+        if_none_match: Optional[str] = Header(None),
+) -> Union[None, LeaseArray]:
     """
     Fetch all DHCP leases from router.
     """
-    return endpoints.get_leases(host)
+    conditional = Conditional(if_none_match)
+    leases = await endpoints.get_leases(host, max_age, fresh, conditional)
+    return FastJSONResponse(leases, headers=conditional.headers)
 
 
 @app.get(
@@ -168,11 +238,18 @@ def router_endpoints_get_leases(host: Optional[str] = None) -> Union[None, Lease
     responses={'201': {'model': Netwatch}},
     tags=['v2'],
 )
-def router_endpoints_get_netwatch(host: Optional[str] = None) -> Union[None, Netwatch]:
+async def router_endpoints_get_netwatch(
+        host: Optional[str] = None,
+        max_age: Optional[int] = Query(None, alias='maxAge', ge=0),
+        fresh: Optional[bool] = False,
+        if_none_match: Optional[str] = Header(None),
+) -> Union[None, Netwatch]:
     """
     Fetch netwatch list from router.
     """
-    return endpoints.get_netwatch(host)
+    conditional = Conditional(if_none_match)
+    netwatch = await endpoints.get_netwatch(host, max_age, fresh, conditional)
+    return FastJSONResponse(netwatch, headers=conditional.headers)
 
 
 @app.get(
@@ -181,12 +258,159 @@ def router_endpoints_get_netwatch(host: Optional[str] = None) -> Union[None, Net
     responses={'201': {'model': Aggregate}},
     tags=['v3'],
 )
-def router_endpoints_get_aggregate_v3(
+async def router_endpoints_get_aggregate_v3(
         host: Optional[str] = None,
         show_default: Optional[bool] = Query(False, alias='showDefault'),
         show_disabled: Optional[bool] = Query(False, alias='showDisabled'),
+        max_age: Optional[int] = Query(None, alias='maxAge', ge=0),
+        fresh: Optional[bool] = False,
+        if_none_match: Optional[str] = Header(None),
 ) -> Union[None, Aggregate]:
-    return endpoints.get_aggregate_v3(host, show_disabled, show_default)
+    conditional = Conditional(if_none_match)
+    aggregate = await endpoints.get_aggregate_v3(host, show_disabled, show_default, max_age, fresh, conditional)
+    return FastJSONResponse(aggregate, headers=conditional.headers)
+
+
+@app.post(
+    '/api/v3/router/capability/batch',
+    response_model=None,
+    responses={'200': {'model': CapabilityBatchResult}},
+    tags=['v3'],
+)
+async def router_endpoints_get_capability_batch(
+        body: CapabilityBatch,
+        concurrency: Optional[int] = Query(None, ge=1),
+        timeout: Optional[float] = Query(None, gt=0),
+        max_age: Optional[int] = Query(None, alias='maxAge', ge=0),
+        fresh: Optional[bool] = False,
+) -> Union[None, CapabilityBatchResult]:
+    """
+    Fetch capability health for many routers and capability subsets in one call, each router queried once.
+    """
+    queries = [query.model_dump() for query in body.root]
+    return FastJSONResponse(await endpoints.get_capability_batch(queries, concurrency, timeout, max_age, fresh))
+
+
+@app.get(
+    '/api/v3/fleet',
+    response_model=None,
+    tags=['v3'],
+)
+async def router_endpoints_get_fleet(
+        host: Optional[List[str]] = Query(None),
+        group: Optional[str] = None,
+        show_default: Optional[bool] = Query(False, alias='showDefault'),
+        show_disabled: Optional[bool] = Query(False, alias='showDisabled'),
+        concurrency: Optional[int] = Query(None, ge=1),
+        timeout: Optional[float] = Query(None, gt=0),
+        max_age: Optional[int] = Query(None, alias='maxAge', ge=0),
+        fresh: Optional[bool] = False,
+) -> StreamingResponse:
+    """
+    Fetch all health information for several routers, one JSON line per router as each one answers.
+    """
+    stream = endpoints.get_fleet(host, group, show_disabled, show_default, concurrency, timeout, max_age, fresh)
+    return StreamingResponse(stream, media_type='application/x-ndjson')
+
+
+@app.get(
+    '/api/v3/router/devices',
+    response_model=None,
+    tags=['v3'],
+)
+async def router_endpoints_get_devices(
+        host: Optional[str] = None,
+        capability: Optional[str] = None,
+        unhealthy: Optional[bool] = False,
+        address: Optional[str] = None,
+        mac: Optional[str] = None,
+        max_age: Optional[int] = Query(None, alias='maxAge', ge=0),
+        fresh: Optional[bool] = False,
+        if_none_match: Optional[str] = Header(None),
+) -> JSONResponse:
+    """
+    One record per device, joining its DHCP lease and netwatch status with the capabilities it belongs to.
+    """
+    conditional = Conditional(if_none_match)
+    devices = await endpoints.get_devices(host, capability, unhealthy, address, mac, max_age, fresh, conditional)
+    return FastJSONResponse(devices, headers=conditional.headers)
+
+
+@app.get(
+    '/api/v3/router/history',
+    response_model=None,
+    tags=['v3'],
+)
+async def router_endpoints_get_history(
+        host: Optional[str] = None,
+        window: Optional[int] = Query(3600, gt=0, description='Seconds back from now to compute statistics over'),
+        kind: Optional[str] = Query(None, pattern='^(leases|netwatch)$'),
+) -> JSONResponse:
+    """
+    Uptime percentage, flap count and last transition of every lease and netwatch entry of a polled or followed router.
+    """
+    return FastJSONResponse(endpoints.get_history(host, window, kind))
+
+
+@app.get(
+    '/api/v3/router/events',
+    response_model=None,
+    tags=['v3'],
+)
+async def router_endpoints_get_health_events(host: Optional[str] = None) -> StreamingResponse:
+    """
+    Stream capability health, lease status and netwatch status changes as server-sent events.
+    """
+    return StreamingResponse(endpoints.get_health_events(host), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# Stored backups and diffs are gzip files, sent as they are to clients that accept gzip
+def stored_file_response(request: Request, path: str, filename: str):
+    disposition = {'Content-Disposition': f'attachment; filename="{filename}"', 'Vary': 'Accept-Encoding'}
+    if accepts_encoding(request.headers.get('accept-encoding'), 'gzip'):
+        return FileResponse(path, media_type='text/plain', headers=dict(disposition, **{'Content-Encoding': 'gzip'}))
+    return StreamingResponse(endpoints.router.backups.iter_read(path), media_type='text/plain', headers=disposition)
+
+
+@app.get(
+    '/api/v3/backup/{host}',
+    response_model=None,
+    tags=['v3'],
+)
+async def router_endpoints_get_backup(
+        request: Request,
+        host: str,
+        version: Optional[str] = None,
+):
+    """
+    Download a stored config backup of a router, the latest one unless a version is given.
+    """
+    path, filename = endpoints.get_backup(host, version)
+    return stored_file_response(request, path, filename)
+
+
+@app.get(
+    '/api/v3/backup/{host}/diff',
+    response_model=None,
+    tags=['v3'],
+)
+async def router_endpoints_get_backup_diff(
+        request: Request,
+        host: str,
+        from_version: Optional[str] = Query(None, alias='from'),
+        to_version: Optional[str] = Query(None, alias='to'),
+):
+    """
+    Unified diff between two stored config backups of a router. Defaults to the latest backup and the one before it.
+    """
+    path, filename = await endpoints.get_backup_diff(host, from_version, to_version)
+    return stored_file_response(request, path, filename)
+
+
+@app.get('/metrics', include_in_schema=False)
+def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
 
 @app.get("/api")
@@ -0,0 +1,240 @@
+# Copyright 2024 Comcast Cable Communications Management, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+"""Load test of the API against local stand-ins for a router, compared with a saved baseline.
+Run from the root directory with `python -m benchmarks.bench_load`, add `--save` to record a new baseline.
+
+A fake RouterOS API server and a fake SSH server are started as subprocesses, the app is configured to use
+them and driven in process through httpx. Micro benchmarks of the lease transform and the capability
+classification run on the same synthetic tables. Baselines are only comparable on the machine they were
+recorded on."""
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baselines', 'load.json')
+
+# the fake router listens on these loopback addresses, so the fleet scenario can address several routers
+FLEET = [f'127.0.0.{i}' for i in range(1, 9)]
+
+# name: (method, path, query parameters, request headers, expected status)
+SCENARIOS = {
+    'aggregate': ('GET', '/api/v3/router/', {}, {}, 200),
+    'aggregate_fresh': ('GET', '/api/v3/router/', {'fresh': 'true'}, {}, 200),
+    'aggregate_not_modified': ('GET', '/api/v3/router/', {}, {'if-none-match': None}, 304),
+    'capability': ('GET', '/api/v2/router/capability', {}, {}, 200),
+    'leases': ('GET', '/api/v2/router/leases', {}, {}, 200),
+    'identity': ('GET', '/api/v2/router/identity', {}, {}, 200),
+    'fleet_fresh': ('GET', '/api/v3/fleet', {'host': FLEET, 'fresh': 'true'}, {}, 200),
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(module, *args):
+    process = subprocess.Popen([sys.executable, '-m', module, *args], stdout=subprocess.PIPE, text=True)
+    # both servers print one line once they accept connections
+    process.stdout.readline()
+    return process
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def summarize(latencies, elapsed, errors):
+    return {
+        'requests': len(latencies),
+        'rps': round(len(latencies) / elapsed, 1) if elapsed else 0,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'errors': errors,
+    }
+
+
+async def drive(client, scenario, requests, concurrency):
+    method, path, params, headers, expected = scenario
+    if 'if-none-match' in headers:
+        headers = dict(headers, **{'if-none-match': (await client.request(method, path, params=params)).headers['etag']})
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            response = await client.request(method, path, params=params, headers=headers)
+            latencies.append(time.perf_counter() - started)
+            if response.status_code != expected:
+                errors += 1
+
+    # a few untimed requests fill pools and caches
+    await asyncio.gather(*(client.request(method, path, params=params, headers=headers) for _ in range(concurrency)))
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(requests)))
+    return summarize(latencies, time.perf_counter() - started, errors)
+
+
+async def run_load(args, results):
+    import httpx
+    from app import app
+    from mt_query.router import endpoints
+
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://bench') as client:
+            for name in args.scenarios:
+                results[name] = await drive(client, SCENARIOS[name], args.requests, args.concurrency)
+                print_row(name, results[name])
+
+        latencies = []
+        errors = 0
+        started = time.perf_counter()
+        for _ in range(args.backups):
+            begun = time.perf_counter()
+            try:
+                await asyncio.to_thread(endpoints.router.backup_config)
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - begun)
+        if args.backups:
+            results['backup'] = summarize(latencies, time.perf_counter() - started, errors)
+            print_row('backup', results['backup'])
+
+
+def run_micro(args, results):
+    from benchmarks.fake_routeros import make_tables
+    from mt_query.router import endpoints
+    from mt_query.router.common import make_camel_case, project_rows
+
+    rows = make_tables(args.leases)['/ip/dhcp-server/lease/print']
+    leases = endpoints.format_leases(rows)
+    micro = {
+        'micro_project_rows': lambda: project_rows(rows, endpoints.Router.columns['leases']),
+        'micro_make_camel_case': lambda: make_camel_case(rows),
+        'micro_format_leases': lambda: endpoints.format_leases(rows),
+        'micro_build_capability': lambda: endpoints.build_capability(leases),
+    }
+    for name, call in micro.items():
+        latencies = []
+        started = time.perf_counter()
+        for _ in range(args.micro_repeat):
+            begun = time.perf_counter()
+            call()
+            latencies.append(time.perf_counter() - begun)
+        results[name] = summarize(latencies, time.perf_counter() - started, 0)
+        print_row(name, results[name])
+
+
+def print_row(name, result):
+    print(f"{name:<24} {result['requests']:>8} {result['rps']:>10} {result['p50_ms']:>10} {result['p99_ms']:>10} "
+          f"{result['errors']:>7}", flush=True)
+
+
+# Return the names of results that are slower than the baseline by more than the tolerance
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        slower = result['p50_ms'] > base['p50_ms'] * (1 + tolerance)
+        fewer = result['rps'] < base['rps'] / (1 + tolerance)
+        if slower or fewer or result['errors'] > base['errors']:
+            regressions.append(name)
+            print(f"REGRESSION {name}: p50 {base['p50_ms']} -> {result['p50_ms']} ms, "
+                  f"rps {base['rps']} -> {result['rps']}, errors {base['errors']} -> {result['errors']}")
+    return regressions
+
+
+def main(args):
+    workdir = tempfile.mkdtemp(prefix='mtquery-bench-')
+    api_port, ssh_port = free_port(), free_port()
+    servers = [
+        start_server('benchmarks.fake_routeros', '--host', *FLEET, '--port', str(api_port),
+                     '--leases', str(args.leases), '--latency', str(args.latency)),
+        start_server('benchmarks.fake_ssh', '--port', str(ssh_port), '--lines', str(args.export_lines),
+                     '--changing'),
+    ]
+    try:
+        config_path = os.path.join(workdir, 'config.yml')
+        with open(config_path, 'w') as f:
+            yaml.safe_dump({'host': '127.0.0.1', 'username': 'bench', 'password': 'bench', 'api_port': api_port,
+                            'ssh_port': ssh_port, 'backup_interval': 60,
+                            'pool': {'max_size': args.concurrency}}, f)
+        os.environ['MT_QUERY_CONFIG'] = config_path
+        os.environ.setdefault('ENVIRONMENT', 'development')
+        from mt_query.config import AppConf
+        AppConf.set('backup_path', os.path.join(workdir, 'config_backup'))
+
+        print(f"{'scenario':<24} {'requests':>8} {'rps':>10} {'p50 ms':>10} {'p99 ms':>10} {'errors':>7}")
+        results = {}
+        asyncio.run(run_load(args, results))
+        run_micro(args, results)
+    finally:
+        for server in servers:
+            server.terminate()
+            server.wait()
+
+    if args.save:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump({'machine': platform.platform(), 'python': platform.python_version(),
+                       'settings': dict((key, value) for key, value in vars(args).items()
+                                        if key not in ('save', 'baseline')),
+                       'results': results}, f, indent=2)
+        print(f"baseline written to {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get('settings', {}).get('leases') != args.leases:
+        print(f"baseline was recorded with {baseline['settings'].get('leases')} leases, not comparing")
+        return 0
+    return 1 if compare(results, baseline['results'], args.tolerance) else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='API load test against local RouterOS stand-ins')
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--requests', type=int, default=500, help='timed requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--leases', type=int, default=1000, help='rows in the fake lease table')
+    parser.add_argument('--latency', type=float, default=0.002, help='seconds the fake router takes per command')
+    parser.add_argument('--backups', type=int, default=5, help='config exports to time, 0 to skip')
+    parser.add_argument('--export-lines', type=int, default=5000)
+    parser.add_argument('--micro-repeat', type=int, default=200)
+    parser.add_argument('--tolerance', type=float, default=0.5, help='allowed slowdown against the baseline')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save', action='store_true', help='record the results as the new baseline')
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,81 @@
+# Copyright 2024 Comcast Cable Communications Management, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+
+import argparse
+import json
+import timeit
+
+from fastapi.encoders import jsonable_encoder
+
+from benchmarks.bench_transform import make_leases
+from mt_query.config import AppConf
+from mt_query.model.response import Compressor, brotli, dumps, json_adapter, json_default
+from mt_query.router import endpoints
+from mt_query.router.capability import CapabilityIndex
+from mt_query.router.leases import Lease, LeaseView
+
+"""Micro-benchmark of aggregate response encoding on synthetic lease tables.
+Run from the root directory with `ENVIRONMENT=development python -m benchmarks.bench_serialize`."""
+
+
+# Leases are held as compact records, which the generic encoders do not know
+RECORDS = {Lease: Lease.as_json, LeaseView: LeaseView.as_json}
+
+
+def make_aggregate(count):
+    leases = endpoints.format_leases(make_leases(count))
+    return {
+        'identity': endpoints.format_identity([{'name': 'router'}]),
+        'firmware': endpoints.format_firmware([{'factory-firmware': '6.45.9', 'current-firmware': '7.14.3',
+                                                'upgrade-firmware': '7.14.3', 'model': 'RB5009UG+S+'}]),
+        'capability': endpoints.build_capability(leases),
+        'leases': leases,
+        'netwatch': [{'comment': f'device {i}', 'host': f'192.168.100.{i + 1}', 'status': 'up',
+                      'since': 'jan/02/2024 10:00:00'} for i in range(50)],
+    }
+
+
+def compressed_size(body, encoding, level):
+    compressor = Compressor(encoding, level)
+    return len(compressor.compress(body) + compressor.finish())
+
+
+def run(sizes, repeat):
+    print(f"{'rows':>8} {'encoder ms':>12} {'adapter ms':>12} {'dumps ms':>10} {'speedup':>8} "
+          f"{'bytes':>10} {'gzip':>10} {'br':>10}")
+    for size in sizes:
+        aggregate = make_aggregate(size)
+        # what FastAPI does for a route returning a dict, told how to turn lease records into JSON values
+        encoder = min(timeit.repeat(lambda: json.dumps(jsonable_encoder(aggregate, custom_encoder=RECORDS)).encode(),
+                                    number=1, repeat=repeat))
+        adapter = min(timeit.repeat(lambda: json_adapter.serializer.to_json(aggregate, fallback=json_default),
+                                    number=1, repeat=repeat))
+        fast = min(timeit.repeat(lambda: dumps(aggregate), number=1, repeat=repeat))
+        body = dumps(aggregate)
+        br = compressed_size(body, 'br', 4) if brotli is not None else 0
+        print(f"{size:>8} {encoder * 1000:>12.2f} {adapter * 1000:>12.2f} {fast * 1000:>10.2f} "
+              f"{encoder / fast:>7.1f}x {len(body):>10} {compressed_size(body, 'gzip', 6):>10} {br or '-':>10}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Aggregate response encoding micro-benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    # normally compiled at application startup
+    endpoints.capability_index = CapabilityIndex(AppConf.open(AppConf.get_capability_map_file_path(), 'capabilities'))
+    run(args.sizes, args.repeat)
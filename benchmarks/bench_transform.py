@@ -0,0 +1,83 @@
+# Copyright 2024 Comcast Cable Communications Management, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+
+import argparse
+import timeit
+from re import split
+
+from mt_query.router.common import project_rows
+
+"""Micro-benchmark of the lease row transform on synthetic lease tables.
+Run from the root directory with `python -m benchmarks.bench_transform`."""
+
+LEASE_KEYS = ('comment', 'address', 'mac-address', 'status', 'disabled', 'last-seen')
+
+
+def make_leases(count):
+    # columns roughly as returned by /ip/dhcp-server/lease/print
+    return [{
+        '.id': f'*{i + 1:X}',
+        'address': f'192.168.{100 + i // 250}.{i % 250 + 1}',
+        'mac-address': f'00:11:22:33:{i // 256 % 256:02X}:{i % 256:02X}',
+        'client-id': f'1:0:11:22:33:{i // 256 % 256:02x}:{i % 256:02x}',
+        'address-lists': '',
+        'server': 'dhcp1',
+        'dhcp-option': '',
+        'status': 'bound' if i % 7 else 'waiting',
+        'expires-after': '9m58s',
+        'last-seen': '2s',
+        'active-address': f'192.168.{100 + i // 250}.{i % 250 + 1}',
+        'active-mac-address': f'00:11:22:33:{i // 256 % 256:02X}:{i % 256:02X}',
+        'host-name': f'device-{i}',
+        'radius': False,
+        'dynamic': False,
+        'blocked': False,
+        'disabled': False,
+        'comment': f'device {i}',
+    } for i in range(count)]
+
+
+# The transform as it was before project_rows: camelCase every column in place, one regex split per key
+def legacy_make_camel_case(objects):
+    for obj in objects:
+        for key in list(obj.keys()):
+            key_arr = split('([^a-zA-Z0-9])', key)
+            key_arr = [i for i in key_arr if i.isalnum()]
+            new_key = ''.join([j.title() if i > 0 else j for i, j in enumerate(key_arr)])
+            obj[new_key] = obj.pop(key)
+    return objects
+
+
+def run(sizes, repeat):
+    print(f"{'rows':>8} {'legacy ms':>12} {'project ms':>12} {'speedup':>8}")
+    for size in sizes:
+        leases = make_leases(size)
+        # the legacy transform mutates its input, so every run gets fresh copies
+        legacy = min(timeit.repeat(lambda: legacy_make_camel_case([dict(row) for row in leases]),
+                                   number=1, repeat=repeat))
+        copies = min(timeit.repeat(lambda: [dict(row) for row in leases], number=1, repeat=repeat))
+        legacy = max(legacy - copies, 0)
+        fused = min(timeit.repeat(lambda: project_rows(leases, LEASE_KEYS), number=1, repeat=repeat))
+        print(f"{size:>8} {legacy * 1000:>12.2f} {fused * 1000:>12.2f} {legacy / fused:>7.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Lease transform micro-benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    run(args.sizes, args.repeat)
@@ -0,0 +1,267 @@
+# Copyright 2024 Comcast Cable Communications Management, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+
+import argparse
+import asyncio
+import ipaddress
+import re
+
+from librouteros.protocol import Decoder, Encoder
+
+"""Stand-in for the RouterOS API on localhost, serving synthetic tables over the real wire protocol.
+Run from the root directory with `python -m benchmarks.fake_routeros --port 18728 --leases 500`.
+
+Any username and password are accepted. Tagged commands are answered concurrently, `.proplist` is honoured
+and prints are filtered by their query words like RouterOS does. Listen commands stay open until cancelled and
+receive the changes made through FakeRouterOS.change. A print reply holds the rows as they were when the
+command arrived, however long the reply is delayed."""
+
+
+def make_tables(leases=250, netwatch=20):
+    # addresses cycle through 192.168.100.1-250 so every capability of the default map has leases
+    lease_rows = [{
+        '.id': f'*{i + 1:X}',
+        'address': f'192.168.{100 + i // 250}.{i % 250 + 1}',
+        'mac-address': f'00:11:22:33:{i // 256 % 256:02X}:{i % 256:02X}',
+        'client-id': f'1:0:11:22:33:{i // 256 % 256:02x}:{i % 256:02x}',
+        'server': 'dhcp1',
+        'status': 'bound' if i % 7 else 'waiting',
+        'expires-after': '9m58s',
+        'last-seen': '2s',
+        'host-name': f'device-{i}',
+        'dynamic': 'false',
+        'blocked': 'false',
+        'disabled': 'false',
+        'comment': f'device {i}',
+    } for i in range(leases)]
+    netwatch_rows = [{
+        '.id': f'*{i + 1:X}',
+        'host': f'192.168.100.{i + 1}',
+        'status': 'up' if i % 5 else 'down',
+        'since': 'jan/02/2024 10:00:00',
+        'timeout': '1s',
+        'interval': '10s',
+        'comment': f'device {i}',
+    } for i in range(netwatch)]
+    return {
+        '/system/identity/print': [{'name': 'bench-router'}],
+        '/system/routerboard/print': [{'routerboard': 'true', 'model': 'RB5009UG+S+', 'serial-number': 'HD00000',
+                                       'firmware-type': 'arm64', 'factory-firmware': '7.1.5',
+                                       'current-firmware': '7.14.3', 'upgrade-firmware': '7.14.3'}],
+        '/ip/dhcp-server/lease/print': lease_rows,
+        '/tool/netwatch/print': netwatch_rows,
+        '/ip/firewall/nat/print': [],
+    }
+
+
+# Addresses and numbers are compared by value, like RouterOS compares typed properties, anything else as text
+def query_value(value):
+    try:
+        return 0, int(ipaddress.ip_address(value))
+    except ValueError:
+        pass
+    try:
+        return 1, int(value)
+    except ValueError:
+        return 2, value
+
+
+def query_compare(row, name, operator, value):
+    if name not in row:
+        return False
+    left, right = query_value(row[name]), query_value(value)
+    if left[0] != right[0]:
+        return False
+    return {'=': left == right, '<': left < right, '>': left > right}[operator]
+
+
+def query_matches(row, words):
+    """
+    Evaluate RouterOS query words against a row. Every word pushes a result onto a stack, ?# words combine
+    the results on it, and the row matches when every result left on the stack is true.
+    """
+    stack = []
+    for word in words:
+        word = word[1:]
+        if word.startswith('#'):
+            for operation in re.findall(r'\d+|[|&!.]', word[1:]):
+                if operation == '|':
+                    right, left = stack.pop(), stack.pop()
+                    stack.append(left or right)
+                elif operation == '&':
+                    right, left = stack.pop(), stack.pop()
+                    stack.append(left and right)
+                elif operation == '!':
+                    stack.append(not stack.pop())
+                elif operation == '.':
+                    stack.append(stack[-1])
+                else:
+                    stack.append(stack[int(operation)])
+        elif word.startswith('-'):
+            stack.append(word[1:] not in row)
+        elif word[:1] in ('=', '<', '>') and '=' in word[1:]:
+            name, value = word[1:].split('=', 1)
+            stack.append(query_compare(row, name, word[0], value))
+        elif '=' in word:
+            name, value = word.split('=', 1)
+            stack.append(query_compare(row, name, '=', value))
+        else:
+            stack.append(word in row)
+    return all(stack)
+
+
+class FakeRouterOS:
+
+    def __init__(self, tables=None, latency=0.0):
+        self.tables = tables or make_tables()
+        # seconds added before every reply
+        self.latency = latency
+        self.logins = 0
+        self.commands = 0
+        # open listen commands as (path, send, writer, tag)
+        self.listens = []
+        self._encoder = Encoder()
+        self._encoder.encoding = 'ASCII'
+
+    async def serve(self, hosts=('127.0.0.1',), port=18728):
+        return await asyncio.start_server(self._session, list(hosts), port)
+
+    async def change(self, path, row):
+        """
+        Add, update or, with .dead set, remove a row of the table at path, e.g. /ip/dhcp-server/lease, and
+        send the change to every listen on it the way RouterOS does, as the whole item.
+        """
+        rows = self.tables[f'{path}/print']
+        position = next((i for i, item in enumerate(rows) if item.get('.id') == row['.id']), None)
+        if row.get('.dead'):
+            if position is not None:
+                del rows[position]
+            item = row
+        elif position is None:
+            item = dict(row)
+            rows.append(item)
+        else:
+            # replaced rather than modified, replies being delayed still hold the old item
+            item = rows[position] = dict(rows[position], **row)
+        writers = set()
+        for listen_path, send, writer, tag in self.listens:
+            if listen_path == path:
+                send('!re', f'.tag={tag}', *(f'={key}={value}' for key, value in item.items()))
+                writers.add(writer)
+        for writer in writers:
+            await writer.drain()
+
+    async def _read_word(self, reader):
+        first = await reader.readexactly(1)
+        if first == b'\x00':
+            return ''
+        length = Decoder.decodeLength(first + await reader.readexactly(Decoder.determineLength(first)))
+        return (await reader.readexactly(length)).decode('ASCII')
+
+    async def _read_sentence(self, reader):
+        words = []
+        while True:
+            word = await self._read_word(reader)
+            if not word:
+                return words
+            words.append(word)
+
+    async def _session(self, reader, writer):
+        listens = {}
+        tasks = set()
+
+        def send(*words):
+            writer.write(self._encoder.encodeSentence(*words))
+
+        try:
+            while True:
+                sentence = await self._read_sentence(reader)
+                if not sentence:
+                    continue
+                command, words = sentence[0], sentence[1:]
+                attributes = dict(word[1:].split('=', 1) for word in words if word.startswith('='))
+                tag = [word for word in words if word.startswith('.tag=')][:1]
+                self.commands += 1
+                if command == '/login':
+                    self.logins += 1
+                    send('!done', *tag)
+                elif command == '/quit':
+                    send('!fatal', 'session terminated on request')
+                    break
+                elif command.endswith('/listen'):
+                    listen = (command[:-len('/listen')], send, writer, tag[0][len('.tag='):] if tag else '')
+                    listens[listen[3]] = listen
+                    self.listens.append(listen)
+                elif command == '/cancel':
+                    cancelled = attributes.get('tag')
+                    listen = listens.pop(cancelled, None)
+                    if listen:
+                        self.listens.remove(listen)
+                        send('!trap', '=category=2', '=message=interrupted', f'.tag={cancelled}')
+                        send('!done', f'.tag={cancelled}')
+                    send('!done', *tag)
+                else:
+                    query = [word for word in words if word.startswith('?')]
+                    task = asyncio.ensure_future(self._reply(send, writer, command, attributes, query, tag))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            for listen in listens.values():
+                self.listens.remove(listen)
+            writer.close()
+
+    async def _reply(self, send, writer, command, attributes, query, tag):
+        rows = self.tables.get(command)
+        rows = None if rows is None else list(rows)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if rows is None:
+            send('!trap', '=message=no such command prefix', *tag)
+            send('!done', *tag)
+        else:
+            columns = attributes.get('.proplist')
+            columns = columns.split(',') if columns else None
+            for row in rows:
+                if query and not query_matches(row, query):
+                    continue
+                send('!re', *tag, *(f'={key}={value}' for key, value in row.items()
+                                    if columns is None or key in columns))
+            send('!done', *tag)
+        await writer.drain()
+
+
+async def main(args):
+    router = FakeRouterOS(make_tables(args.leases, args.netwatch), args.latency)
+    server = await router.serve(args.host, args.port)
+    print(f"fake RouterOS API listening on {', '.join(args.host)} port {args.port}", flush=True)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Fake RouterOS API server')
+    parser.add_argument('--host', nargs='+', default=['127.0.0.1'], help='addresses to listen on')
+    parser.add_argument('--port', type=int, default=18728)
+    parser.add_argument('--leases', type=int, default=250)
+    parser.add_argument('--netwatch', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added before every reply')
+    asyncio.run(main(parser.parse_args()))
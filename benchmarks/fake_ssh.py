@@ -0,0 +1,126 @@
+# Copyright 2024 Comcast Cable Communications Management, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+
+import argparse
+import datetime as dt
+import socket
+import threading
+import time
+
+import paramiko
+
+"""Stand-in for the RouterOS SSH service on localhost, answering `/export compact` with a synthetic config.
+Run from the root directory with `python -m benchmarks.fake_ssh --port 18022 --lines 5000`.
+
+Any username and password are accepted. Every export carries the current time in its header line, like
+the real one, and the rest of the config only changes when --changing is given."""
+
+
+def make_export(lines, serial=0):
+    header = f"# {dt.datetime.now().strftime('%b/%d/%Y %H:%M:%S').lower()} by RouterOS 7.14.3\n"
+    body = ''.join(f"add address=192.168.{100 + i // 250}.{i % 250 + 1} comment=\"device {i}\" "
+                   f"mac-address=00:11:22:33:{i // 256 % 256:02X}:{i % 256:02X} server=dhcp1\n"
+                   for i in range(lines))
+    return (header + "# software id = BENCH-0000\n/ip dhcp-server lease\n" + body
+            + f"/system identity\nset name=bench-router-{serial}\n").encode()
+
+
+class ExportServer(paramiko.ServerInterface):
+
+    def __init__(self):
+        self.command = None
+        self.requested = threading.Event()
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_exec_request(self, channel, command):
+        self.command = command.decode()
+        self.requested.set()
+        return True
+
+
+class FakeSSH:
+
+    def __init__(self, lines=5000, latency=0.0, changing=False, chunk_size=32 * 1024):
+        self.lines = lines
+        # seconds added before the export is sent
+        self.latency = latency
+        self.changing = changing
+        self.chunk_size = chunk_size
+        self.exports = 0
+        self.host_key = paramiko.RSAKey.generate(2048)
+
+    def serve(self, host='127.0.0.1', port=18022):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((host, port))
+        listener.listen(64)
+        thread = threading.Thread(target=self._accept, args=(listener,), daemon=True)
+        thread.start()
+        return listener
+
+    def _accept(self, listener):
+        while True:
+            client, _ = listener.accept()
+            threading.Thread(target=self._session, args=(client,), daemon=True).start()
+
+    def _session(self, client):
+        transport = paramiko.Transport(client)
+        transport.add_server_key(self.host_key)
+        server = ExportServer()
+        try:
+            transport.start_server(server=server)
+            channel = transport.accept(30)
+            if channel is None or not server.requested.wait(30):
+                return
+            if server.command.strip() == '/export compact':
+                time.sleep(self.latency)
+                self.exports += 1
+                export = make_export(self.lines, self.exports if self.changing else 0)
+                for start in range(0, len(export), self.chunk_size):
+                    channel.sendall(export[start:start + self.chunk_size])
+                channel.send_exit_status(0)
+            else:
+                channel.sendall_stderr(f"bad command name {server.command}\n".encode())
+                channel.send_exit_status(1)
+            channel.close()
+        except (paramiko.SSHException, EOFError, OSError):
+            pass
+        finally:
+            transport.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Fake RouterOS SSH server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=18022)
+    parser.add_argument('--lines', type=int, default=5000)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added before the export is sent')
+    parser.add_argument('--changing', action='store_true', help='change the config on every export')
+    args = parser.parse_args()
+    FakeSSH(args.lines, args.latency, args.changing).serve(args.host, args.port)
+    print(f"fake RouterOS SSH listening on {args.host}:{args.port}", flush=True)
+    threading.Event().wait()
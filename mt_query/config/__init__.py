@@ -42,7 +42,9 @@ class AppConf:
     @staticmethod
     def get_config_file_path():
 
-        if 'ENVIRONMENT' in os.environ and os.environ['ENVIRONMENT'] == 'development':
+        if 'MT_QUERY_CONFIG' in os.environ:
+            config_path = os.environ['MT_QUERY_CONFIG']
+        elif 'ENVIRONMENT' in os.environ and os.environ['ENVIRONMENT'] == 'development':
             config_path = "mt_query/resource/config.yml"
         else:
             config_path = "/mt-query-ms/mt_query/resource/config.yml"
@@ -60,13 +62,16 @@ class AppConf:
         else:
             raise NameError("Invalid key: {}".format(key))
 
+    # Parse a YAML file, optionally returning one of its sections. Invalid files raise ValueError
     @staticmethod
     def open(path, key=None):
         with open(path, 'r') as stream:
             try:
                 obj = yaml.safe_load(stream)
-                if key:
-                    obj = obj.get(key)
-                return obj
             except yaml.YAMLError as exc:
-                print(exc)
+                raise ValueError(f"{path} is not valid YAML: {exc}") from exc
+        if key:
+            if not isinstance(obj, dict) or key not in obj:
+                raise ValueError(f"{path} has no {key} section")
+            obj = obj[key]
+        return obj
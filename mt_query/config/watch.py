@@ -0,0 +1,53 @@
+# Copyright 2024 Comcast Cable Communications Management, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+
+import logging
+import os
+
+"""This file is used to reload configuration files when they change on disk.
+Files are checked by their stat, so a check costs one system call per file. A reload that fails, e.g. on
+invalid YAML, is logged and the previously loaded version stays in use."""
+
+
+def file_stamp(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    # the inode changes when a file is replaced, e.g. by a mounted config map
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
+class FileWatcher:
+
+    def __init__(self):
+        self._files = {}
+
+    # Call reload with the path whenever the file changes from now on
+    def add(self, path, reload):
+        self._files[path] = [file_stamp(path), reload]
+
+    def check(self):
+        for path, entry in self._files.items():
+            stamp = file_stamp(path)
+            if stamp is None or stamp == entry[0]:
+                continue
+            entry[0] = stamp
+            try:
+                entry[1](path)
+            except Exception as e:
+                logging.error(f"not reloading {path}, keeping the previous version: {str(e)}")
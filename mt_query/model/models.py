@@ -18,7 +18,7 @@
 from __future__ import annotations
 
 from enum import Enum
-from typing import List, Optional, Set
+from typing import Dict, List, Optional, Set
 
 from pydantic import BaseModel, Field, RootModel
 
@@ -132,3 +132,35 @@ class Aggregate(BaseModel):
     leases: Optional[LeaseArray] = None
     netwatch: Optional[Netwatch] = None
     firmware: Optional[Firmware] = None
+
+
+class CapabilityQuery(BaseModel):
+    host: Optional[str] = Field(None, example='192.168.100.1')
+    capabilities: Optional[List[str]] = Field(
+        None,
+        description='Capabilities to return, every capability of the map when not given.',
+        example=['IRR', 'TCE', 'PWR'],
+    )
+    showDefault: Optional[bool] = False
+    showDisabled: Optional[bool] = False
+
+
+class CapabilityBatch(RootModel):
+    root: List[CapabilityQuery] = Field(..., min_length=1, max_length=500)
+
+
+class BatchError(BaseModel):
+    status: int = Field(..., example=504)
+    message: str = Field(..., example='No reply from 192.168.100.1 within 10s')
+
+
+class CapabilityBatchItem(BaseModel):
+    host: str = Field(..., example='192.168.100.1')
+    capability: Optional[Dict[str, Optional[CapabilityV2]]] = None
+    error: Optional[BatchError] = None
+    elapsed: float = Field(..., description='Seconds from the start of the batch until the router of this query answered.')
+
+
+class CapabilityBatchResult(BaseModel):
+    results: List[CapabilityBatchItem] = Field(..., description='One result per query, in request order.')
+    elapsed: float = Field(..., description='Seconds taken by the whole batch.')
@@ -0,0 +1,162 @@
+# Copyright 2024 Comcast Cable Communications Management, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+
+import json
+import zlib
+from typing import Any
+
+from fastapi.responses import JSONResponse
+from pydantic import TypeAdapter
+from pydantic_core import PydanticSerializationError
+from starlette.datastructures import Headers, MutableHeaders
+
+from mt_query.router.common import accepts_encoding
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+"""This file is used to encode API responses.
+Endpoint payloads are plain dicts and lists, so they are written straight to JSON bytes instead of going
+through FastAPI's generic encoder, and large bodies are compressed with the best coding the client accepts."""
+
+# Compiled once and used when orjson is not installed
+json_adapter = TypeAdapter(Any)
+
+
+# Objects holding their data compactly, e.g. lease records, are turned into JSON values only when written
+def json_default(obj):
+    if hasattr(obj, 'as_json'):
+        return obj.as_json()
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+def dumps(content):
+    if orjson is not None:
+        return orjson.dumps(content, default=json_default, option=orjson.OPT_NON_STR_KEYS)
+    try:
+        return json_adapter.serializer.to_json(content, fallback=json_default)
+    except PydanticSerializationError:
+        return json.dumps(content, default=json_default, separators=(',', ':')).encode()
+
+
+class FastJSONResponse(JSONResponse):
+
+    def render(self, content):
+        return dumps(content)
+
+
+# Content codings in order of preference, brotli only when the module is installed
+def choose_encoding(header):
+    for encoding in (('br',) if brotli is not None else ()) + ('gzip',):
+        if accepts_encoding(header, encoding):
+            return encoding
+    return None
+
+
+class Compressor:
+
+    def __init__(self, encoding, level):
+        self.encoding = encoding
+        if encoding == 'br':
+            self._compressor = brotli.Compressor(quality=level)
+        else:
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._compressor.process(data) if self.encoding == 'br' else self._compressor.compress(data)
+
+    # Everything written so far, decodable by the client without waiting for more
+    def flush(self):
+        return self._compressor.flush() if self.encoding == 'br' else self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.finish() if self.encoding == 'br' else self._compressor.flush()
+
+
+class CompressionMiddleware:
+
+    # Event streams are left alone, proxies tend to hold back compressed chunks
+    excluded_types = ('text/event-stream',)
+
+    def __init__(self, app, settings=None, **options):
+        self.app = app
+        # callable returning the options, read on the first request as the config is loaded at startup
+        self.settings = settings
+        self.configure(**options)
+
+    def configure(self, minimum_size=1024, gzip_level=6, brotli_level=4):
+        self.minimum_size = minimum_size
+        self.levels = {'gzip': gzip_level, 'br': brotli_level}
+
+    async def __call__(self, scope, receive, send):
+        if self.settings is not None and scope['type'] == 'http':
+            self.configure(**(self.settings() or {}))
+            self.settings = None
+        encoding = choose_encoding(Headers(scope=scope).get('accept-encoding')) if scope['type'] == 'http' else None
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start = {}
+        compressor = None
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal compressor, passthrough
+            if message['type'] == 'http.response.start':
+                start.update(message)
+                return
+            if message['type'] != 'http.response.body':
+                await send(message)
+                return
+
+            body = message.get('body', b'')
+            more_body = message.get('more_body', False)
+            if compressor is None and not passthrough:
+                headers = Headers(raw=start['headers'])
+                passthrough = ('content-encoding' in headers
+                               or headers.get('content-type', '').startswith(self.excluded_types)
+                               or (not more_body and len(body) < self.minimum_size))
+                if not passthrough:
+                    compressor = Compressor(encoding, self.levels[encoding])
+                    headers = MutableHeaders(raw=start['headers'])
+                    headers['Content-Encoding'] = encoding
+                    headers.add_vary_header('Accept-Encoding')
+                    del headers['Content-Length']
+                    if not more_body:
+                        body = compressor.compress(body) + compressor.finish()
+                        headers['Content-Length'] = str(len(body))
+                        await send(start)
+                        await send({'type': 'http.response.body', 'body': body})
+                        return
+                await send(start)
+            if passthrough:
+                await send(message)
+                return
+
+            # streamed bodies are flushed per chunk so every line reaches the client as it is written
+            body = compressor.compress(body) + (compressor.flush() if more_body else compressor.finish())
+            await send({'type': 'http.response.body', 'body': body, 'more_body': more_body})
+
+        await self.app(scope, receive, send_compressed)
@@ -15,22 +15,55 @@
 # SPDX-License-Identifier: Apache-2.0
 
 
-import os
-import glob
-from librouteros import connect
+import asyncio
 from librouteros.exceptions import ConnectionClosed, TrapError
-from werkzeug.exceptions import abort
+import time
+from werkzeug.exceptions import HTTPException, abort
 from mt_query.config import AppConf
 from paramiko import SSHClient, AutoAddPolicy
-from os import path
 import datetime as dt
 import logging
-from apscheduler.schedulers.background import BackgroundScheduler
-from threading import Semaphore
+import os
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from mt_query.router.client import connect
+from mt_query.router.pool import ConnectionPool, PoolExhausted
+from mt_query.router.cache import ResponseCache
+from mt_query.router.snapshot import Poller, SnapshotStore
+from mt_query.router.follow import Follower
+from mt_query.router.history import TRACKED, StatusHistory
+from mt_query.router.leases import compact
+from mt_query.router.backup_store import BackupStore
+from mt_query.router.backup_scheduler import BackupScheduler
+from mt_query.router.breaker import CircuitBreaker
+from mt_query.router.leader import LeaderLock
+from mt_query.router.shared import SharedStore
+from mt_query.router import metrics
 
 
 class Router:
 
+    # Commands whose replies are cached, keyed by the name used in the cache
+    commands = {
+        'identity': '/system/identity/print',
+        'firmware': '/system/routerboard/print',
+        'leases': '/ip/dhcp-server/lease/print',
+        'netwatch': '/tool/netwatch/print',
+        # only the leases inside the capability ranges, see queries
+        'capability_leases': '/ip/dhcp-server/lease/print',
+    }
+
+    # Columns the router is asked to return (.proplist), limited to what the endpoints use
+    columns = {
+        'identity': ('name',),
+        'firmware': ('factory-firmware', 'current-firmware', 'upgrade-firmware', 'model'),
+        'leases': ('comment', 'address', 'mac-address', 'status', 'disabled', 'last-seen'),
+        'netwatch': ('comment', 'host', 'status', 'since'),
+        'capability_leases': ('comment', 'address', 'mac-address', 'status', 'disabled', 'last-seen'),
+    }
+
+    # Commands fetched together for an aggregate request and by the poller
+    aggregate = ('identity', 'firmware', 'leases', 'netwatch')
+
     # Minimal object for logging into the router
     def __init__(self, credentials):
         conf = AppConf.config('credentials')
@@ -38,114 +71,389 @@ class Router:
         self.host = credentials.get('host') or conf.get('host')
         self.user = conf.get('username')
         self.password = conf.get('password')
-        self.backup_interval = conf.get('backup_interval')
-        self.connection = None
-        self.backup_semaphore = Semaphore(1)
+        self.api_port = conf.get('api_port', 8728)
+        self.ssh_port = conf.get('ssh_port', 22)
+        self.backup_interval = conf.get('backup_interval') or 2
+        retention_conf = conf.get('backup_retention') or {}
+        self.backups = BackupStore(self.backup_path, **retention_conf)
+        backup_conf = dict(conf.get('backup') or {})
+        timeout_conf = conf.get('timeouts') or {}
+        self.timeouts = {
+            'connect': timeout_conf.get('connect', 10),
+            'command': timeout_conf.get('command', 30),
+            'ssh': timeout_conf.get('ssh', backup_conf.pop('timeout', 60)),
+        }
+        # per host overrides of any of the above
+        self.host_timeouts = timeout_conf.get('hosts') or {}
+        self.backup_scheduler = BackupScheduler(self._backup_host, backup_conf.pop('hosts', None) or [self.host],
+                                                self.backup_interval, **backup_conf)
+        pool_conf = conf.get('pool') or {}
+        self.pool = ConnectionPool(self.login, **pool_conf)
+        # worker processes of one deployment elect a leader and may share router replies through this directory
+        cluster_conf = conf.get('cluster') or {}
+        cluster_path = cluster_conf.get('path') or self.backup_path
+        self.leader = LeaderLock(os.path.join(cluster_path, 'leader.lock'))
+        self.leader_retry = cluster_conf.get('leader_retry', 10)
+        shared = SharedStore(os.path.join(cluster_path, 'cache.sqlite3')) if cluster_conf.get('shared_cache') else None
+        cache_conf = conf.get('cache') or {}
+        # lease tables are kept as compact records
+        self.cache = ResponseCache(shared=shared, convert=compact, **cache_conf)
+        breaker_conf = conf.get('breaker') or {}
+        self.breaker = CircuitBreaker(self._probe, forget=self.forget_host, **breaker_conf)
+        # RouterOS query words sent with a named command to filter rows on the router
+        self.queries = {}
+
+        self.snapshots = SnapshotStore()
+        poll_conf = conf.get('poll') or {}
+        self.poller = Poller(self, self.snapshots, **poll_conf)
+        follow_conf = conf.get('follow') or {}
+        self.follower = Follower(self, **follow_conf)
+        # status changes of polled and followed routers
+        history_conf = dict(conf.get('history') or {})
+        # how often the other workers take the leader's polled and followed tables from the shared cache
+        self.history_sync = history_conf.pop('sync_interval', 5)
+        self._history_synced = {}
+        self.history = StatusHistory(**history_conf)
+        self.snapshots.listeners.append(lambda snapshot: self.history.record(snapshot.host, snapshot.data,
+                                                                             snapshot.updated))
+        self.follower.listeners.append(self._record_followed)
 
-        # schedule background job
-        self.scheduler = BackgroundScheduler()
+        # background jobs run on the application event loop once start() is called
+        self.scheduler = AsyncIOScheduler()
+        metrics.watch_scheduler(self.scheduler)
+
+    # Record a full load of a followed table as a whole, and a single change by its row only
+    def _record_followed(self, host, name, table, change):
+        if change is None:
+            self.history.record(host, {name: table.list()})
+        else:
+            self.history.record_change(host, name, *change)
+
+    def start(self):
         self.scheduler.start()
-        self.scheduler.add_job(self.backup_config, 'interval', minutes=2, 
-                               name=f"{self.host}-backup")
+        if not self.lead():
+            self.scheduler.add_job(self.elect, 'interval', seconds=self.leader_retry, id='leader-election')
+            if self.cache.shared is not None:
+                self.scheduler.add_job(self.sync_history, 'interval', seconds=self.history_sync, id='history-sync',
+                                       coalesce=True, max_instances=1)
+
+    # Schedule backups and polls if this process becomes the leader, return whether it is
+    def lead(self):
+        if self.leader.held:
+            return True
+        if not self.leader.acquire():
+            metrics.LEADER.set(0)
+            return False
+        metrics.LEADER.set(1)
+        self.backup_scheduler.schedule(self.scheduler)
+        self.poller.schedule(self.scheduler)
+        # one listen session per router for the whole deployment
+        self.follower.start()
+        if self.cache.shared is not None:
+            self.follower.schedule(self.scheduler)
+        return True
+
+    # Retried by followers, so another worker takes over when the leader exits
+    async def elect(self):
+        if self.lead():
+            self.scheduler.remove_job('leader-election')
+            # the history is recorded from this process's own polls and follows from now on
+            if self.scheduler.get_job('history-sync'):
+                self.scheduler.remove_job('history-sync')
+
+    # Record the history of the hosts the leader polls and follows from the tables it shared
+    async def sync_history(self):
+        shared = self.cache.shared
+        for host in dict.fromkeys(self.poller.hosts + self.follower.hosts):
+            found = await shared.run(shared.get_many, host, list(TRACKED))
+            for name, (rows, age) in found.items():
+                fetched_at = time.time() - age
+                if fetched_at > self._history_synced.get((host, name), 0):
+                    self._history_synced[(host, name)] = fetched_at
+                    self.history.record(host, {name: rows}, fetched_at)
+
+    # Return whether this process polls a host on schedule, which only the leader does
+    def polling(self, host):
+        return self.leader.held and host in self.poller.hosts
+
+    # Keep local data for a host current while something depends on it
+    def watch(self, host):
+        if not self.follower.following(host) and not self.polling(host):
+            self.poller.add(self.scheduler, host)
+
+    def unwatch(self, host):
+        if not self.polling(host):
+            self.poller.remove(self.scheduler, host)
+
+    def shutdown(self):
+        self.follower.stop()
+        self.breaker.stop()
+        self.scheduler.shutdown(wait=False)
+        self.pool.close()
+        self.leader.release()
+        if self.cache.shared is not None:
+            self.cache.shared.close()
+
+    # Apply changed credentials, other settings take effect on restart
+    def reload_credentials(self, conf):
+        self.host = conf.get('host') or self.host
+        self.user = conf.get('username')
+        self.password = conf.get('password')
+        # idle sessions were opened with the old credentials
+        self.pool.close()
+
+    # Return the connect, command or ssh timeout in seconds for a host
+    def timeout(self, host, kind):
+        return (self.host_timeouts.get(host) or {}).get(kind, self.timeouts[kind])
 
     # Try to login, raise exception if unsuccessful
-    def login(self, host):
+    async def login(self, host):
+        host = host or self.host
+        started = time.perf_counter()
         try:
-            self.connection = connect(username=self.user, password=self.password, host=host or self.host)
+            connection = await connect(username=self.user, password=self.password, host=host, port=self.api_port,
+                                       timeout=self.timeout(host, 'connect'))
         except TrapError:
+            metrics.ROUTER_LOGINS.labels(host, 'denied').inc()
             abort(400, "Username or password not valid")
+        except asyncio.TimeoutError:
+            metrics.ROUTER_LOGINS.labels(host, 'timeout').inc()
+            abort(404, "Could not connect to host: {}".format(host))
+        except (ConnectionClosed, OSError):
+            metrics.ROUTER_LOGINS.labels(host, 'unreachable').inc()
+            abort(404, "Could not connect to host: {}".format(host))
+        metrics.ROUTER_LOGINS.labels(host, 'ok').inc()
+        metrics.ROUTER_LOGIN_SECONDS.labels(host).observe(time.perf_counter() - started)
+        return connection
+
+    # Return the output of a command
+    async def command(self, connection, command, *words):
+        return await connection(command, *words)
+
+    # Run a command and record its latency, reply size or failure
+    async def _measured_command(self, connection, host, command, *words):
+        started = time.perf_counter()
+        try:
+            rows = await asyncio.wait_for(self.command(connection, command, *words), self.timeout(host, 'command'))
+        except asyncio.TimeoutError:
+            metrics.ROUTER_COMMAND_ERRORS.labels(host, command, 'timeout').inc()
+            # the reply may still arrive later, so the session is not handed out again
+            connection.close()
+            abort(504, f"No reply from host: {host} to {command} within {self.timeout(host, 'command')}s")
+        except TrapError:
+            metrics.ROUTER_COMMAND_ERRORS.labels(host, command, 'trap').inc()
+            raise
         except ConnectionClosed:
-            abort(404, "Could not connect to host: {}".format(self.host))
+            metrics.ROUTER_COMMAND_ERRORS.labels(host, command, 'connection').inc()
+            raise
+        except asyncio.CancelledError:
+            # requests cut off by a timeout, e.g. the fleet deadline
+            metrics.ROUTER_COMMAND_ERRORS.labels(host, command, 'cancelled').inc()
+            raise
+        metrics.ROUTER_COMMAND_SECONDS.labels(host, command).observe(time.perf_counter() - started)
+        metrics.ROUTER_COMMAND_ROWS.labels(host, command).set(len(rows))
+        return rows
 
-    def logout(self):
-        self.connection.close()
+    # Return the command of a cached name with its .proplist and query words
+    def sentence(self, name):
+        words = [self.commands[name]]
+        if name in self.columns:
+            words.append(f"=.proplist={','.join(self.columns[name])}")
+        words.extend(self.queries.get(name, ()))
+        return words
 
-    # Return the output of a command
-    def command(self, command):
-        return self.connection(cmd=command)
+    async def make_call(self, command, host, *words):
+        return (await self.make_calls({command: [command, *words]}, host)).get(command)
+
+    # Run several commands over a single pooled session, each given as its command word followed by any
+    # further words and keyed by the given names
+    async def make_calls(self, commands, host):
+        host = host or self.host
+        self.breaker.check(host)
+        try:
+            results = await self._make_calls(commands, host)
+        except HTTPException as e:
+            # unreachable or unresponsive routers, not failed commands or a busy pool
+            if e.code in (404, 504):
+                self.breaker.failure(host, e.description)
+            raise
+        self.breaker.success(host)
+        return results
+
+    # Drop the pooled sessions and metrics of a router the breaker gave up on
+    def forget_host(self, host):
+        self.pool.forget(host)
+        metrics.forget_host(host)
+
+    # Answer the breaker's background probe of an unavailable router
+    async def _probe(self, host):
+        await self._make_calls({'identity': self.sentence('identity')}, host)
+
+    async def _make_calls(self, commands, host):
+        # a pooled session may have been closed by the router, so retry once on a fresh one
+        for attempt in range(2):
+            try:
+                async with self.pool.connection(host) as connection:
+                    # commands are tagged, so they all run concurrently on the one session
+                    results = await asyncio.gather(*(self._measured_command(connection, host, *sentence)
+                                                     for sentence in commands.values()))
+                    return dict(zip(commands, results))
+            except ConnectionClosed:
+                if attempt:
+                    abort(404, "Could not connect to host: {}".format(host))
+            except PoolExhausted as e:
+                metrics.ROUTER_COMMAND_ERRORS.labels(host, 'pool', 'timeout').inc()
+                abort(503, str(e))
+
+    # Return whatever of the named commands is held locally, from followed tables or the poller snapshot
+    def local_calls(self, names, host, max_age=None):
+        host = host or self.host
+        # followed tables are kept current by the router itself, so they are never stale
+        values = self.follower.lookup(host, names)
+        remaining = [name for name in names if name not in values]
+        snapshot = self.poller.lookup(host, remaining, max_age) if remaining else None
+        if snapshot:
+            values.update((name, snapshot.data[name]) for name in remaining)
+        return values
+
+    # Return the last data held for an unavailable router, regardless of its age
+    async def last_known(self, names, host):
+        values = self.follower.lookup(host, names)
+        snapshot = self.snapshots.get(host)
+        for name in names:
+            if name in values:
+                continue
+            if snapshot and name in snapshot.data:
+                values[name] = snapshot.data[name]
+            else:
+                value = await self.cache.peek(host, name)
+                if value is not None:
+                    values[name] = value
+        return values
+
+    # Serve the named commands from local data or the cache, loading any misses together over one session
+    async def cached_calls(self, names, host, max_age=None, fresh=False):
+        host = host or self.host
+        if fresh:
+            max_age = 0
+            values = {}
+        elif self.breaker.is_open(host):
+            # the router is not asked while its circuit is open, last known data beats an error
+            values = await self.last_known(names, host)
+        else:
+            values = self.local_calls(names, host, max_age)
+
+        async def fetch(missing):
+            return await self.make_calls(dict((name, self.sentence(name)) for name in missing), host)
+
+        missing = [name for name in names if name not in values]
+        if missing:
+            values.update(await self.cache.get_many(host, missing, fetch, max_age))
+        return values
+
+    async def get_aggregate(self, host, max_age=None, fresh=False):
+        return await self.cached_calls(list(self.aggregate), host, max_age, fresh)
 
-    def make_call(self, command, host):
-        self.login(host)
-        data = [data for data in self.command(command)]
-        self.logout()
-        return data
+    async def get_identity(self, host, max_age=None, fresh=False):
+        return (await self.cached_calls(['identity'], host, max_age, fresh)).get('identity')
 
-    def get_identity(self, host):
-        command = '/system/identity/print'
-        return self.make_call(command, host)
+    async def get_leases(self, host, max_age=None, fresh=False):
+        return (await self.cached_calls(['leases'], host, max_age, fresh)).get('leases')
 
-    def get_leases(self, host):
-        command = '/ip/dhcp-server/lease/print'
-        return self.make_call(command, host)
+    async def get_capability_leases(self, host, max_age=None, fresh=False):
+        # a full lease table held locally covers the filtered one
+        if not fresh:
+            local = self.local_calls(['leases'], host, max_age)
+            if 'leases' in local:
+                return local['leases']
+        return (await self.cached_calls(['capability_leases'], host, max_age, fresh)).get('capability_leases')
 
-    def get_nat(self, host):
+    async def get_nat(self, host):
         command = '/ip/firewall/nat/print'
-        return self.make_call(command, host)
+        return await self.make_call(command, host)
 
-    def get_firmware(self, host):
-        command = '/system/routerboard/print'
-        return self.make_call(command, host)
+    async def get_firmware(self, host, max_age=None, fresh=False):
+        return (await self.cached_calls(['firmware'], host, max_age, fresh)).get('firmware')
 
-    def get_netwatch(self, host):
-        command = '/tool/netwatch/print'
-        return self.make_call(command, host)
+    async def get_netwatch(self, host, max_age=None, fresh=False):
+        return (await self.cached_calls(['netwatch'], host, max_age, fresh)).get('netwatch')
     
-    def _ssh_command_exec(self, host, command, port=22):
+    # Yield the output of a command in chunks as it arrives over SSH
+    def _ssh_command_stream(self, host, command, port=None, chunk_size=64 * 1024):
+        port = port or self.ssh_port
+        timeout = self.timeout(host, 'ssh')
         ssh_client = SSHClient()
         ssh_client.set_missing_host_key_policy(AutoAddPolicy)
 
         try:
-            # needs "allow_agent=False" for MikroTik
-            ssh_client.connect(hostname=self.host, username=self.user, 
-                               password=self.password, port=port, allow_agent=False)
-        except Exception as e:
-            logging.error(f"SSH connection to {self.host}:{port} failed with {str(e)}")
-            abort(401, f"SSH connection to {self.host}:{port} failed.")
-        try:
-            stdin, stdout, stderr = ssh_client.exec_command(command=command)
-        except Exception as e:
-            logging.error(f"SSH command execution on {self.host}:{port} for {command} failed with {str(e)}")
+            try:
+                # needs "allow_agent=False" for MikroTik
+                ssh_client.connect(hostname=host, username=self.user, password=self.password, port=port,
+                                   allow_agent=False, timeout=timeout, banner_timeout=timeout, auth_timeout=timeout)
+            except Exception as e:
+                logging.error(f"SSH connection to {host}:{port} failed with {str(e)}")
+                abort(401, f"SSH connection to {host}:{port} failed.")
+            try:
+                stdin, stdout, stderr = ssh_client.exec_command(command=command, timeout=timeout)
+                # a hung session fails the read instead of holding the backup worker forever
+                size = 0
+                while True:
+                    chunk = stdout.channel.recv(chunk_size)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    yield chunk
+                # the output of a failed command ends the same way, so the exit status decides
+                if not stdout.channel.status_event.wait(timeout):
+                    raise TimeoutError(f"no exit status within {timeout}s")
+                status = stdout.channel.recv_exit_status()
+                if status or not size:
+                    error = stderr.read().decode('utf-8', errors='replace').strip()
+                    raise RuntimeError(f"exit status {status}" + ('' if size else ' without output')
+                                       + (f": {error}" if error else ''))
+            except Exception as e:
+                logging.error(f"SSH command execution on {host}:{port} for {command} failed with {str(e)}")
+                abort(404, f"Execution of '{command}' on {host}:{port} failed.")
+        finally:
+            ssh_client.close()
 
-            abort(404, f"Execution of '{command}' on {self.host}:{port} failed.")
+    def _ssh_command_exec(self, host, command, port=None):
+        return b''.join(self._ssh_command_stream(host, command, port))
 
-        output = stdout.read()
-        return output
-    
-    def backup_config(self):
-        command = '/export compact'
-        logging.info(f"creating config backup for host: {self.host}")
+    # Back up a host, waiting for a backup of the same host that is already running
+    def backup_config(self, host=None):
+        return self.backup_scheduler.run(host or self.host)
 
-        # avoid scheduled jobs stepping on API initiated calls.
-        self.backup_semaphore.acquire(timeout=60)
-        config_file = self._ssh_command_exec(host=self.host, command=command)
+    def _backup_host(self, host):
+        command = '/export compact'
+        logging.info(f"creating config backup for host: {host}")
 
-        config_file_name = f"{self.host}.rsc"
-        try: 
-            with open(os.path.join(self.backup_path, config_file_name), "wb") as f:
-                f.write(config_file)
+        try:
+            # the export goes straight from the SSH channel to disk
+            version, changed = self.backups.save_stream(host, self._ssh_command_stream(host=host, command=command))
+        except HTTPException:
+            raise
         except Exception as e:
-            logging.error(f"writing config backup for host: {self.host} to {config_file} failed with {str(e)}")
-            self.backup_semaphore.release()
+            logging.error(f"writing config backup for host: {host} to {self.backup_path} failed with {str(e)}")
             abort(500, "Failed to write config backup to disk.")
-        self.backup_semaphore.release()
-        return config_file_name
-    
+        metrics.BACKUP_BYTES.labels(host).set(version['size'])
+        if not changed:
+            logging.info(f"config of host: {host} unchanged since backup {version['id']}")
+        return version['id']
+
     def get_config_info(self):
-        output = {"backups": [], "backup_interval": self.backup_interval, "jobs": []} 
-        try:
-            for filename in glob.iglob(f"{self.backup_path}/*.rsc"):
-                file_epoch_time = path.getmtime(filename)
-                output["backups"].append({"name": os.path.basename(filename), 
-                               "last_modified": 
-                                dt.datetime.utcfromtimestamp(file_epoch_time).isoformat(),
-                                "size": os.path.getsize(filename=filename)}
-                               )
-        except OSError as e:
-            abort(404, "No backup file found!")
+        output = {"backups": [], "backup_interval": self.backup_interval, "jobs": [],
+                  "backup_stats": self.backup_scheduler.get_stats()}
+        for host in self.backups.hosts():
+            for version in reversed(self.backups.versions(host)):
+                output["backups"].append({"host": host, "name": version["id"],
+                                          "last_modified":
+                                          dt.datetime.utcfromtimestamp(version["created"]).isoformat(),
+                                          "size": version["size"],
+                                          "stored_size": version["stored_size"]})
 
         for j in self.scheduler.get_jobs():
             output["jobs"].append({"id": j.id, "name": j.name, 
                                    "next_run": j.next_run_time.astimezone(
                                        dt.timezone.utc).isoformat()})
         return output
-
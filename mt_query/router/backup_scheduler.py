@@ -0,0 +1,113 @@
+# Copyright 2024 Comcast Cable Communications Management, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+
+import datetime as dt
+import logging
+import random
+import time
+from threading import Lock
+
+from apscheduler.executors.pool import ThreadPoolExecutor
+from werkzeug.exceptions import HTTPException, abort
+
+from mt_query.router import metrics
+
+"""This file is used to schedule configuration backups for every configured router.
+Exports run in a bounded pool of worker threads, start times are spread with jitter and each host
+is only ever backed up by one worker at a time."""
+
+
+class BackupScheduler:
+
+    def __init__(self, backup, hosts, default_interval=2, workers=4, jitter=30, lock_timeout=60):
+        # backup is called with a host and returns the id of the stored version
+        self.backup = backup
+        self.hosts = {}
+        for entry in hosts:
+            if isinstance(entry, dict):
+                self.hosts[entry['host']] = entry.get('interval') or default_interval
+            else:
+                self.hosts[entry] = default_interval
+        self.workers = workers
+        self.jitter = jitter
+        self.lock_timeout = lock_timeout
+        self.stats = {}
+        self._locks = {}
+        self._guard = Lock()
+
+    def schedule(self, scheduler):
+        scheduler.add_executor(ThreadPoolExecutor(self.workers), 'backup')
+        now = dt.datetime.now(dt.timezone.utc)
+        for host, interval in self.hosts.items():
+            # spread the first runs over one interval so the fleet is not exported in one burst
+            first_run = now + dt.timedelta(seconds=random.uniform(0, interval * 60))
+            scheduler.add_job(self._job, 'interval', minutes=interval, jitter=self.jitter, args=[host],
+                              id=f"{host}-backup", name=f"{host}-backup", executor='backup',
+                              next_run_time=first_run, coalesce=True, max_instances=1)
+
+    def _host_lock(self, host):
+        with self._guard:
+            return self._locks.setdefault(host, Lock())
+
+    def run(self, host):
+        lock = self._host_lock(host)
+        if not lock.acquire(timeout=self.lock_timeout):
+            self._record(host, skipped=True)
+            abort(409, f"A backup of {host} is already running.")
+        started = time.monotonic()
+        try:
+            version_id = self.backup(host)
+        except Exception as e:
+            metrics.BACKUP_SECONDS.labels(host, 'failed').observe(time.monotonic() - started)
+            self._record(host, duration=time.monotonic() - started,
+                         error=e.description if isinstance(e, HTTPException) else str(e))
+            raise
+        finally:
+            lock.release()
+        metrics.BACKUP_SECONDS.labels(host, 'ok').observe(time.monotonic() - started)
+        self._record(host, duration=time.monotonic() - started)
+        return version_id
+
+    def _job(self, host):
+        try:
+            self.run(host)
+        except HTTPException as e:
+            logging.error(f"scheduled config backup for host: {host} failed with {e.description}")
+        except Exception as e:
+            logging.error(f"scheduled config backup for host: {host} failed with {str(e)}")
+
+    def _record(self, host, duration=None, error=None, skipped=False):
+        with self._guard:
+            stats = self.stats.setdefault(host, {'runs': 0, 'failures': 0, 'consecutive_failures': 0,
+                                                 'skipped': 0, 'last_duration': None, 'last_success': None,
+                                                 'last_error': None})
+            if skipped:
+                stats['skipped'] += 1
+                return
+            stats['runs'] += 1
+            stats['last_duration'] = round(duration, 3)
+            if error:
+                stats['failures'] += 1
+                stats['consecutive_failures'] += 1
+                stats['last_error'] = error
+            else:
+                stats['consecutive_failures'] = 0
+                stats['last_success'] = dt.datetime.now(dt.timezone.utc).isoformat()
+
+    def get_stats(self):
+        with self._guard:
+            return dict((host, dict(stats)) for host, stats in self.stats.items())
@@ -0,0 +1,265 @@
+# Copyright 2024 Comcast Cable Communications Management, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+
+import datetime as dt
+import difflib
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+from contextlib import contextmanager
+from threading import Lock
+
+"""This file is used to store router configuration exports by content.
+An export is only written when it differs from the previous one, versions are gzip compressed and an
+index per host lists them without scanning the backup directory. Exports are written and read in chunks,
+and diffs between versions are computed on first request and kept next to the versions."""
+
+# The header line of an export carries the time it was taken, so it is ignored when comparing exports
+EXPORT_HEADER = re.compile(rb'^# .*by RouterOS.*$', re.MULTILINE)
+
+
+class ExportDigest:
+    """SHA-256 of an export without its header line, fed the export in chunks of any size."""
+
+    def __init__(self):
+        self._hash = hashlib.sha256()
+        self._partial = b''
+        self._header_seen = False
+
+    def update(self, chunk):
+        lines = (self._partial + chunk).split(b'\n')
+        self._partial = lines.pop()
+        for line in lines:
+            self._line(line)
+            self._hash.update(b'\n')
+
+    def _line(self, line):
+        if not self._header_seen and EXPORT_HEADER.fullmatch(line):
+            self._header_seen = True
+        else:
+            self._hash.update(line)
+
+    def hexdigest(self):
+        self._line(self._partial)
+        self._partial = b''
+        return self._hash.hexdigest()
+
+
+@contextmanager
+def atomic_file(path):
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_atomic(path, data):
+    with atomic_file(path) as f:
+        f.write(data)
+
+
+class BackupStore:
+
+    def __init__(self, path, keep_count=None, keep_days=None, compress_level=6):
+        self.path = path
+        self.keep_count = keep_count
+        self.keep_days = keep_days
+        self.compress_level = compress_level
+        self._lock = Lock()
+        self._indexes = {}
+        self._diff_locks = {}
+
+    def _host_path(self, host, *parts):
+        return os.path.join(self.path, host, *parts)
+
+    def object_path(self, host, digest):
+        return self._host_path(host, 'objects', f"{digest}.rsc.gz")
+
+    def diff_path(self, host, from_id, to_id):
+        return self._host_path(host, 'diffs', f"{from_id}..{to_id}.diff.gz")
+
+    def _index_path(self, host):
+        return self._host_path(host, 'index.json')
+
+    def versions(self, host):
+        """Return the stored versions of a host, oldest first."""
+        with self._lock:
+            return list(self._load_index(host))
+
+    def hosts(self):
+        try:
+            return sorted(name for name in os.listdir(self.path) if os.path.isfile(self._index_path(name)))
+        except OSError:
+            return []
+
+    # The index is rewritten by the leader through os.replace, so the cached copy is kept only while the
+    # inode and modification time of the file stay the same
+    def _load_index(self, host):
+        path = self._index_path(host)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self._indexes.pop(host, None)
+            return []
+        key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        cached = self._indexes.get(host)
+        if cached is None or cached[0] != key:
+            with open(path, 'r') as f:
+                cached = self._indexes[host] = (key, json.load(f))
+        return cached[1]
+
+    def _write_index(self, host, index):
+        path = self._index_path(host)
+        write_atomic(path, json.dumps(index, indent=1).encode())
+        stat = os.stat(path)
+        self._indexes[host] = ((stat.st_ino, stat.st_mtime_ns, stat.st_size), index)
+
+    def save_stream(self, host, chunks):
+        """
+        Store an export of a host unless it matches the latest stored version. The export is compressed to
+        disk as the chunks arrive, so it is never held in memory as a whole.
+
+        :returns: The version entry and whether a new version was added.
+        """
+        os.makedirs(self._host_path(host, 'objects'), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self._host_path(host, 'objects'), prefix='.tmp-')
+        try:
+            digest = ExportDigest()
+            size = 0
+            with os.fdopen(fd, 'wb') as raw:
+                with gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=self.compress_level) as f:
+                    for chunk in chunks:
+                        digest.update(chunk)
+                        f.write(chunk)
+                        size += len(chunk)
+                raw.flush()
+                os.fsync(raw.fileno())
+            digest = digest.hexdigest()
+
+            with self._lock:
+                index = self._load_index(host)
+                if index and index[-1]['digest'] == digest:
+                    return index[-1], False
+
+                object_path = self.object_path(host, digest)
+                # a config that was reverted to an older state still has its object on disk
+                if not os.path.exists(object_path):
+                    os.replace(tmp_path, object_path)
+                now = time.time()
+                version = {
+                    'id': f"{dt.datetime.fromtimestamp(now, dt.timezone.utc).strftime('%Y%m%dT%H%M%SZ')}-{digest[:12]}",
+                    'digest': digest,
+                    'created': now,
+                    'size': size,
+                    'stored_size': os.path.getsize(object_path),
+                }
+                index = self._apply_retention(host, index + [version], now)
+                self._write_index(host, index)
+                return version, True
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _apply_retention(self, host, index, now):
+        keep = list(index)
+        if self.keep_days is not None:
+            cutoff = now - self.keep_days * 86400
+            keep = [version for version in keep if version['created'] >= cutoff]
+        if self.keep_count is not None:
+            keep = keep[-self.keep_count:] if self.keep_count > 0 else []
+        # the latest version is never dropped
+        if not keep:
+            keep = index[-1:]
+        # objects are shared by versions with the same content, only remove the ones nothing refers to
+        done = set(version['digest'] for version in keep)
+        for version in index:
+            if version['digest'] not in done:
+                done.add(version['digest'])
+                try:
+                    os.remove(self.object_path(host, version['digest']))
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logging.error(f"removing backup {version['id']} of {host} failed with {str(e)}")
+        self._remove_diffs(host, set(version['id'] for version in keep))
+        return keep
+
+    def _remove_diffs(self, host, kept_ids):
+        try:
+            names = os.listdir(self._host_path(host, 'diffs'))
+        except FileNotFoundError:
+            return
+        for name in names:
+            ids = name[:-len('.diff.gz')].split('..') if name.endswith('.diff.gz') else ()
+            if not ids or any(version_id not in kept_ids for version_id in ids):
+                try:
+                    os.remove(self._host_path(host, 'diffs', name))
+                except OSError:
+                    pass
+
+    def iter_read(self, path, chunk_size=64 * 1024):
+        """Yield the uncompressed content of a stored object or diff in chunks."""
+        with gzip.open(path, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+    def _iter_lines(self, host, version):
+        with gzip.open(self.object_path(host, version['digest']), 'rt', encoding='utf-8', errors='replace') as f:
+            yield from f
+
+    def diff(self, host, from_version, to_version):
+        """
+        Return the path of the gzip compressed unified diff between two versions, computing it on first use.
+        """
+        path = self.diff_path(host, from_version['id'], to_version['id'])
+        if os.path.exists(path):
+            return path
+        with self._lock:
+            lock = self._diff_locks.setdefault(path, Lock())
+        # concurrent requests for the same diff wait for the first one instead of computing it again
+        with lock:
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # difflib needs both sides as line lists, the output is written as it is produced
+                lines = difflib.unified_diff(list(self._iter_lines(host, from_version)),
+                                             list(self._iter_lines(host, to_version)),
+                                             fromfile=from_version['id'], tofile=to_version['id'])
+                with atomic_file(path) as raw, gzip.GzipFile(fileobj=raw, mode='wb',
+                                                             compresslevel=self.compress_level) as f:
+                    for line in lines:
+                        f.write(line.encode('utf-8'))
+                        if not line.endswith('\n'):
+                            f.write(b'\n')
+        with self._lock:
+            self._diff_locks.pop(path, None)
+        return path
@@ -0,0 +1,127 @@
+# Copyright 2024 Comcast Cable Communications Management, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+
+import asyncio
+import logging
+import time
+
+from werkzeug.exceptions import abort
+
+from mt_query.router import metrics
+
+"""This file is used to stop sending requests to routers that keep failing.
+After repeated failures the circuit for a host opens, requests fail at once with the last error and a
+background probe with backoff closes the circuit again once the router answers. Hosts nobody asks for any more
+are no longer probed and forgotten."""
+
+
+class HostCircuit:
+
+    def __init__(self):
+        self.failures = 0
+        self.opened = None
+        self.last_error = None
+        self.next_probe = None
+        self.probe = None
+        # last time a request for the host was failed or answered from last known data
+        self.requested = None
+
+
+class CircuitBreaker:
+
+    def __init__(self, probe, failure_threshold=3, reset_timeout=10, max_reset_timeout=300, idle_probes=3,
+                 forget=None):
+        # probe is awaited with a host and raises if the router still does not answer
+        self.probe = probe
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        # failed probes in a row without a request for the host before it is given up on
+        self.idle_probes = idle_probes
+        # called with a host that is given up on, to drop whatever else is kept for it
+        self.forget = forget
+        self._circuits = {}
+
+    def is_open(self, host):
+        circuit = self._circuits.get(host)
+        if circuit is None or circuit.opened is None:
+            return False
+        circuit.requested = time.monotonic()
+        return True
+
+    # Fail at once with the remembered error while the circuit of the host is open
+    def check(self, host):
+        circuit = self._circuits.get(host)
+        if circuit is None or circuit.opened is None:
+            return
+        circuit.requested = time.monotonic()
+        retry_after = max(int(circuit.next_probe - time.monotonic()), 1)
+        abort(503, f"Router {host} is unavailable: {circuit.last_error}", retry_after=retry_after)
+
+    def success(self, host):
+        circuit = self._circuits.pop(host, None)
+        if circuit and circuit.opened is not None:
+            logging.info(f"router {host} answers again after {time.monotonic() - circuit.opened:.0f}s")
+            metrics.ROUTER_CIRCUIT_OPEN.labels(host).set(0)
+
+    def failure(self, host, error):
+        circuit = self._circuits.setdefault(host, HostCircuit())
+        circuit.failures += 1
+        circuit.last_error = error
+        if circuit.opened is None and circuit.failures >= self.failure_threshold:
+            logging.warning(f"opening circuit for router {host} after {circuit.failures} failures: {error}")
+            circuit.opened = circuit.requested = time.monotonic()
+            circuit.next_probe = circuit.opened + self.reset_timeout
+            circuit.probe = asyncio.get_running_loop().create_task(self._probe(host, circuit))
+            metrics.ROUTER_CIRCUIT_OPEN.labels(host).set(1)
+
+    async def _probe(self, host, circuit):
+        delay = self.reset_timeout
+        idle = 0
+        while True:
+            since = time.monotonic()
+            await asyncio.sleep(delay)
+            try:
+                await self.probe(host)
+            except Exception as e:
+                circuit.last_error = getattr(e, 'description', None) or str(e)
+                # e.g. a mistyped host sent by a client once, probing it forever would only cost resources
+                idle = 0 if circuit.requested >= since else idle + 1
+                if idle >= self.idle_probes:
+                    self._give_up(host, circuit)
+                    return
+                delay = min(delay * 2, self.max_reset_timeout)
+                circuit.next_probe = time.monotonic() + delay
+                continue
+            self.success(host)
+            return
+
+    # Forget a host that still does not answer and that nobody asked for during the last probes
+    def _give_up(self, host, circuit):
+        if self._circuits.get(host) is circuit:
+            del self._circuits[host]
+        logging.info(f"stopped probing router {host}, not requested for {self.idle_probes} probes")
+        if self.forget:
+            try:
+                self.forget(host)
+            except Exception as e:
+                logging.warning(f"forgetting router {host} failed with {str(e)}")
+
+    def stop(self):
+        for circuit in self._circuits.values():
+            if circuit.probe:
+                circuit.probe.cancel()
@@ -0,0 +1,205 @@
+# Copyright 2024 Comcast Cable Communications Management, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from functools import partial
+
+"""This file is used to cache router replies per (host, command) so that repeated polls for the same
+router are answered locally. Concurrent requests for an entry that is being loaded share one router call.
+With a shared store, entries missing in this process are looked up there before the router is asked."""
+
+DEFAULT_TTL = {
+    'identity': 60,
+    'firmware': 60,
+    'leases': 5,
+    'netwatch': 5,
+}
+
+FRESH = 'fresh'
+STALE = 'stale'
+MISS = 'miss'
+
+
+class ResponseCache:
+
+    def __init__(self, ttl=None, default_ttl=5, stale_ttl=0, max_entries=1024, shared=None, convert=None):
+        self.ttl = dict(DEFAULT_TTL, **(ttl or {}))
+        self.default_ttl = default_ttl
+        # how long past its ttl an entry may still be served while it is refreshed in the background
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._inflight = {}
+        # the event loop only keeps weak references to tasks, so running loads are held here
+        self._tasks = set()
+        # SharedStore of the worker processes, if any
+        self.shared = shared
+        # called with the name and value of every loaded entry, returns the value to keep
+        self.convert = convert
+
+    async def _states(self, host, names, max_age=None):
+        states = dict((name, self._evaluate((host, name), self._entries.get((host, name)), max_age)) for name in names)
+        if self.shared is None or max_age == 0:
+            return states
+        # another worker may have loaded the entries since
+        names = [name for name, (state, value) in states.items() if state != FRESH]
+        found = await self.shared.run(self.shared.get_many, host, names) if names else {}
+        for name, (value, age) in found.items():
+            shared_state, shared_value = self._evaluate((host, name), self._from_shared((host, name), value, age),
+                                                        max_age)
+            if shared_state != MISS:
+                states[name] = shared_state, shared_value
+        return states
+
+    def _evaluate(self, key, entry, max_age):
+        if entry is None:
+            return MISS, None
+        value, fetched_at = entry
+        self._entries.move_to_end(key)
+        age = time.monotonic() - fetched_at
+        ttl = self.ttl.get(key[1], self.default_ttl)
+        if max_age is not None:
+            # the caller bounds staleness itself, so never serve past it
+            return (FRESH, value) if age <= min(ttl, max_age) else (MISS, None)
+        if age <= ttl:
+            return FRESH, value
+        if age <= ttl + self.stale_ttl:
+            return STALE, value
+        return MISS, None
+
+    def _put(self, key, value, fetched_at=None):
+        self._entries[key] = (value, time.monotonic() if fetched_at is None else fetched_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    # Copy an entry another worker loaded into this process, keeping its age
+    def _from_shared(self, key, value, age):
+        fetched_at = time.monotonic() - age
+        entry = self._entries.get(key)
+        if entry is None or entry[1] < fetched_at:
+            if self.convert is not None:
+                value = self.convert(key[1], value)
+            self._put(key, value, fetched_at)
+        return self._entries[key]
+
+    # Return an entry however old it is, or None
+    async def peek(self, host, name):
+        entry = self._entries.get((host, name))
+        if entry is None and self.shared is not None:
+            found = await self.shared.run(self.shared.get, host, name)
+            if found is not None:
+                entry = self._from_shared((host, name), *found)
+        return entry[0] if entry else None
+
+    # Store a value loaded elsewhere, e.g. a followed table, and share it with the other workers
+    def publish(self, host, name, value):
+        if self.convert is not None:
+            value = self.convert(name, value)
+        self._put((host, name), value)
+        if self.shared is not None:
+            self.shared.run(self.shared.put, host, name, value)
+
+    async def get(self, host, name, fetch, max_age=None):
+        return (await self.get_many(host, [name], fetch, max_age))[name]
+
+    async def get_many(self, host, names, fetch, max_age=None):
+        """
+        Return cached values for the given command names on a host.
+
+        :param fetch: Coroutine function called with the names that need loading. Returns a dict of name to value.
+        :param max_age: Optional maximum age in seconds a returned value may have. 0 always loads from the router.
+        """
+        values = {}
+        stale = []
+        missing = []
+        for name, (state, value) in (await self._states(host, names, max_age)).items():
+            if state == MISS:
+                missing.append(name)
+                continue
+            values[name] = value
+            if state == STALE:
+                stale.append(name)
+
+        if stale:
+            self._load(host, stale, fetch)
+        if missing:
+            futures = self._load(host, missing, fetch)
+            for name, future in futures.items():
+                # shielded so a cancelled request does not cancel a load other requests are waiting on
+                values[name] = await asyncio.shield(future)
+        return values
+
+    # Join loads that are already in flight and start one fetch for the remaining names
+    def _load(self, host, names, fetch):
+        loop = asyncio.get_running_loop()
+        futures = {}
+        start = []
+        for name in names:
+            future = self._inflight.get((host, name))
+            if future is None:
+                start.append(name)
+            else:
+                futures[name] = future
+        if start:
+            for name in start:
+                future = loop.create_future()
+                future.add_done_callback(_consume_exception)
+                self._inflight[(host, name)] = future
+                futures[name] = future
+            task = asyncio.ensure_future(fetch(start))
+            self._tasks.add(task)
+            task.add_done_callback(partial(self._store, host, start))
+        return futures
+
+    def _store(self, host, names, task):
+        self._tasks.discard(task)
+        error = None if task.cancelled() else task.exception()
+        if error:
+            logging.warning(f"loading {', '.join(names)} from {host} failed with {str(error)}")
+        for name in names:
+            future = self._inflight.pop((host, name))
+            if task.cancelled():
+                future.cancel()
+            elif error:
+                future.set_exception(error)
+            else:
+                value = task.result().get(name)
+                if self.convert is not None:
+                    value = self.convert(name, value)
+                self._put((host, name), value)
+                if self.shared is not None:
+                    # written on the store's thread, the result is not waited for
+                    self.shared.run(self.shared.put, host, name, value)
+                future.set_result(value)
+
+    def invalidate(self, host=None, name=None):
+        for key in [key for key in self._entries
+                    if (host is None or key[0] == host) and (name is None or key[1] == name)]:
+            del self._entries[key]
+        if self.shared is not None:
+            # runs before any later shared read, as the store runs its calls in order
+            self.shared.run(self.shared.invalidate, host, name)
+
+
+def _consume_exception(future):
+    # background refreshes may fail without anyone awaiting them
+    if not future.cancelled():
+        future.exception()
@@ -15,7 +15,13 @@
 # SPDX-License-Identifier: Apache-2.0
 
 
-from mt_query.router.common import get_last_octet
+from bisect import bisect_right
+import hashlib
+import ipaddress
+
+from librouteros.query import And, Key, Or
+
+from mt_query.router.common import int_to_ip, ip_to_int
 
 
 """This file is used to define the capabilities of a router.
@@ -26,25 +32,6 @@ def make_capabilities(cap_list):
     return dict((cap, {}) for cap in cap_list)
 
 
-def is_valid(lease, capability, options):
-    correct_ip = is_correct_ip(lease, capability['base_ip'])
-    in_range = is_in_ip_range(lease, capability['start'], capability['end'])
-    not_default = is_not_default_mac(lease, capability['base_mac'], options['showDisabled'])
-    not_disabled = is_not_disabled(lease, options['showDefault'])
-    validity = correct_ip and in_range and not_default and not_disabled
-    return correct_ip and in_range and not_default and not_disabled
-
-
-def is_correct_ip(lease, base_ip):
-    return base_ip in lease.get('address')
-
-
-def is_in_ip_range(lease, start, end):
-    last_octet = get_last_octet(lease.get('address'))
-
-    return start <= last_octet <= end
-
-
 def is_not_default_mac(lease, default_mac, show_default):
     lease_mac = lease.get('macAddress') or ""
     return True if show_default else default_mac not in lease_mac
@@ -57,3 +44,92 @@ def is_not_disabled(lease, show_disabled):
 def health_check(leases):
     lease_health = False if any(not lease.get('isHealthy') for lease in leases) else True
     return lease_health
+
+
+def capability_ranges(capability):
+    """Return the (first, last) integer IPv4 ranges a capability definition covers.
+
+    A capability is defined by a base_ip prefix (or a list of prefixes) with start and end host IDs,
+    and/or by one or more networks in CIDR notation under cidr."""
+    ranges = []
+    base_ips = capability.get('base_ip')
+    if base_ips:
+        for base_ip in base_ips if isinstance(base_ips, list) else [base_ips]:
+            network = ip_to_int(f"{str(base_ip).rstrip('.')}.0")
+            if network is None:
+                raise ValueError(f"base_ip {base_ip} of capability {capability.get('name')} is not a 3 octet prefix")
+            ranges.append((network + capability['start'], network + capability['end']))
+    cidrs = capability.get('cidr') or []
+    for cidr in cidrs if isinstance(cidrs, list) else [cidrs]:
+        network = ipaddress.IPv4Network(cidr, strict=False)
+        ranges.append((int(network.network_address), int(network.broadcast_address)))
+    return ranges
+
+
+class CapabilityIndex:
+    """Capability map compiled into sorted, non-overlapping address intervals.
+
+    Each interval holds the positions of every capability covering it, so a lease is classified with
+    one binary search on its integer address."""
+
+    def __init__(self, capability_map):
+        self.capabilities = list(capability_map or [])
+        # identifies the map in response ETags, responses change when the map does
+        self.fingerprint = hashlib.blake2b(repr(self.capabilities).encode(), digest_size=8).hexdigest()
+        bounds = []
+        for position, capability in enumerate(self.capabilities):
+            if not isinstance(capability, dict) or not capability.get('name'):
+                raise ValueError(f"capability {position + 1} has no name")
+            for first, last in capability_ranges(capability):
+                bounds.append((first, last, position))
+
+        points = sorted(set([first for first, _, _ in bounds] + [last + 1 for _, last, _ in bounds]))
+        self.starts = []
+        self.ends = []
+        self.owners = []
+        for first, following in zip(points, points[1:]):
+            owners = tuple(position for start, end, position in bounds if start <= first and following - 1 <= end)
+            if owners:
+                self.starts.append(first)
+                self.ends.append(following - 1)
+                self.owners.append(owners)
+
+    # Return the positions of the capabilities whose ranges contain the address, given as text or integer
+    def lookup(self, address):
+        ip = address if isinstance(address, int) else ip_to_int(address)
+        if ip is None:
+            return ()
+        i = bisect_right(self.starts, ip) - 1
+        if i < 0 or ip > self.ends[i]:
+            return ()
+        return self.owners[i]
+
+    # Return the covered addresses as (first, last) ranges with adjacent intervals joined
+    def ranges(self):
+        merged = []
+        for first, last in zip(self.starts, self.ends):
+            if merged and merged[-1][1] + 1 == first:
+                merged[-1] = (merged[-1][0], last)
+            else:
+                merged.append((first, last))
+        return merged
+
+    def address_query(self):
+        """Return RouterOS query words that match the addresses covered by the index."""
+        address = Key('address')
+        conditions = []
+        for first, last in self.ranges():
+            bounds = []
+            if first > 0:
+                bounds.append(address > int_to_ip(first - 1))
+            if last < 0xFFFFFFFF:
+                bounds.append(address < int_to_ip(last + 1))
+            conditions.append(And(*bounds) if len(bounds) > 1 else bounds[0])
+        if not conditions:
+            return ()
+        return tuple(Or(*conditions) if len(conditions) > 1 else conditions[0])
+
+    def accepts(self, lease, position, options):
+        base_mac = self.capabilities[position].get('base_mac')
+        not_default = not base_mac or is_not_default_mac(lease, base_mac, options['showDisabled'])
+        return not_default and is_not_disabled(lease, options['showDefault'])
@@ -0,0 +1,190 @@
+# Copyright 2024 Comcast Cable Communications Management, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+
+import asyncio
+import logging
+from itertools import count
+
+from librouteros.exceptions import ConnectionClosed, FatalError, MultiTrapError, TrapError
+from librouteros.protocol import Decoder, Encoder, compose_word, parse_word
+
+"""This file is used to talk to the RouterOS API from asyncio.
+Every command is sent with its own .tag so several commands can be in flight on one session at once."""
+
+
+class AsyncApi(Encoder, Decoder):
+
+    def __init__(self, reader, writer, encoding='ASCII'):
+        self.reader = reader
+        self.writer = writer
+        self.encoding = encoding
+        self.closed = False
+        self._tags = count(1)
+        self._pending = {}
+        self._dispatcher = None
+
+    async def _read_word(self):
+        byte = await self.reader.readexactly(1)
+        if byte == b'\x00':
+            return ''
+        byte += await self.reader.readexactly(self.determineLength(byte))
+        word = await self.reader.readexactly(self.decodeLength(byte))
+        return word.decode(encoding=self.encoding, errors='ignore')
+
+    async def _read_sentence(self):
+        words = []
+        while word := await self._read_word():
+            words.append(word)
+        return words[0], words[1:]
+
+    async def _write_sentence(self, *words):
+        self.writer.write(self.encodeSentence(*words))
+        await self.writer.drain()
+
+    @staticmethod
+    def _parse(words):
+        tag = None
+        attributes = {}
+        for word in words:
+            if word.startswith('.tag='):
+                tag = word[5:]
+            elif word.startswith('='):
+                key, value = parse_word(word)
+                attributes[key] = value
+        return tag, attributes
+
+    async def login(self, username, password):
+        # login happens before the dispatcher runs, so replies are read inline
+        await self._write_sentence('/login', compose_word('name', username), compose_word('password', password))
+        traps = []
+        while True:
+            reply_word, words = await self._read_sentence()
+            _, attributes = self._parse(words)
+            if reply_word == '!trap':
+                traps.append(TrapError(**attributes))
+            elif reply_word == '!fatal':
+                raise FatalError(words[0] if words else '')
+            elif reply_word == '!done':
+                break
+        if traps:
+            raise traps[0]
+
+    def start(self):
+        self._dispatcher = asyncio.get_running_loop().create_task(self._dispatch())
+
+    # Route every reply sentence to the queue of the command that owns its tag
+    async def _dispatch(self):
+        try:
+            while True:
+                reply_word, words = await self._read_sentence()
+                if reply_word == '!fatal':
+                    raise FatalError(words[0] if words else '')
+                tag, attributes = self._parse(words)
+                queue = self._pending.get(tag)
+                if queue is not None:
+                    queue.put_nowait((reply_word, attributes))
+        except FatalError as e:
+            self._fail(e)
+        except (asyncio.IncompleteReadError, ConnectionError, OSError):
+            self._fail(ConnectionClosed('Connection unexpectedly closed.'))
+
+    def _fail(self, error):
+        self.closed = True
+        for queue in self._pending.values():
+            queue.put_nowait(error)
+
+    async def stream(self, cmd, *words, **kwargs):
+        """
+        Send a command and yield each !re row as it arrives.
+
+        :param cmd: Command word. eg. /ip/address/print
+        :param words: Raw API words such as query words.
+        :param kwargs: Attribute words.
+        """
+        tag, queue = await self.send(cmd, *words, **kwargs)
+        async for row in self.replies(tag, queue):
+            yield row
+
+    async def send(self, cmd, *words, **kwargs):
+        """
+        Send a command and return its tag and reply queue, to be read with replies().
+
+        The command is written once this returns, so it is ordered before any command sent after it.
+        """
+        if self.closed:
+            raise ConnectionClosed('Connection already closed.')
+        tag = str(next(self._tags))
+        queue = asyncio.Queue()
+        self._pending[tag] = queue
+        try:
+            attributes = (compose_word(key, value) for key, value in kwargs.items())
+            await self._write_sentence(cmd, *words, *attributes, f'.tag={tag}')
+        except BaseException:
+            self._pending.pop(tag, None)
+            raise
+        return tag, queue
+
+    # Yield each !re row of a sent command as it arrives
+    async def replies(self, tag, queue):
+        try:
+            traps = []
+            while True:
+                reply = await queue.get()
+                if isinstance(reply, Exception):
+                    raise reply
+                reply_word, row = reply
+                if reply_word == '!trap':
+                    traps.append(TrapError(**row))
+                elif reply_word == '!re' or (reply_word == '!done' and row):
+                    yield row
+                if reply_word == '!done':
+                    break
+            if len(traps) > 1:
+                raise MultiTrapError(*traps)
+            if traps:
+                raise traps[0]
+        finally:
+            self._pending.pop(tag, None)
+
+    async def __call__(self, cmd, *words, **kwargs):
+        return [row async for row in self.stream(cmd, *words, **kwargs)]
+
+    def close(self):
+        if self._dispatcher:
+            self._dispatcher.cancel()
+        self._fail(ConnectionClosed('Connection closed.'))
+        try:
+            self.writer.close()
+        except OSError as e:
+            logging.debug(f"closing RouterOS API session failed with {str(e)}")
+
+
+async def connect(host, username, password, port=8728, timeout=10, encoding='ASCII'):
+    """
+    Open a RouterOS API session and login.
+
+    :param timeout: Seconds allowed for the TCP connect and for the login exchange.
+    """
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    api = AsyncApi(reader, writer, encoding)
+    try:
+        await asyncio.wait_for(api.login(username, password), timeout)
+    except BaseException:
+        api.close()
+        raise
+    api.start()
+    return api
@@ -16,43 +16,62 @@
 
 
 from re import split
-import ipaddress
+from functools import lru_cache
+import socket
+
+from mt_query.router.metrics import timed
 
 """This file is used to define common functions that are used throughout the application."""
 
 
+@timed('make_camel_case')
 def make_camel_case(objects, keys=None):
-    if keys:
-        filter_objects(objects, keys)
+    rows = project_rows(objects, keys)
     try:
-        for obj in objects:
-            for key in list(obj.keys()):
-                key_arr = split('([^a-zA-Z0-9])', key)
-                key_arr = [i for i in key_arr if i.isalnum()]
-                new_key = ''.join([j.title() if i > 0 else j for i, j in enumerate(key_arr)])
-                obj[new_key] = obj.pop(key)
-        return objects if len(objects) > 1 else objects[0]
+        return rows if len(rows) > 1 else rows[0]
     except IndexError:
         return {}
 
 
-def filter_objects(objects, keys=None, remove_list=False):
-    if keys:
-        formatted_object = []
-        for obj in objects:
-            response = dict((k, obj.get(k)) for k in keys)
-            formatted_object.append(response)
+@lru_cache(maxsize=1024)
+def camel_case_key(key):
+    key_arr = split('([^a-zA-Z0-9])', key)
+    key_arr = [i for i in key_arr if i.isalnum()]
+    return ''.join([j.title() if i > 0 else j for i, j in enumerate(key_arr)])
+
 
-        return formatted_object
-    else:
-        return objects
+@timed('project_rows')
+def project_rows(objects, keys=None):
+    """Return new dicts holding only the requested keys of each row, renamed to camelCase.
 
+    Keys missing from a row are returned as None. Without keys every column is kept."""
+    if not keys:
+        return [dict((camel_case_key(key), value) for key, value in obj.items()) for obj in objects]
+    table = tuple((key, camel_case_key(key)) for key in keys)
+    return [dict((new_key, obj.get(key)) for key, new_key in table) for obj in objects]
 
-def get_last_octet(ip):
+
+def ip_to_int(ip):
     try:
-        ipaddr = ipaddress.ip_address(ip)
-    except ValueError:
-        return 11
-    ip_arr = ip.split('.')
-    last_octet = int(ip_arr[len(ip_arr) - 1])
-    return last_octet
+        return int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big')
+    except (OSError, TypeError):
+        return None
+
+
+def int_to_ip(value):
+    return socket.inet_ntoa(value.to_bytes(4, 'big'))
+
+
+# Return whether an Accept-Encoding header allows the given content coding
+def accepts_encoding(header, encoding):
+    for item in (header or '').split(','):
+        name, _, params = item.strip().partition(';')
+        if name.strip().lower() in (encoding, '*'):
+            quality = params.strip()
+            if not quality.startswith('q='):
+                return True
+            try:
+                return float(quality[2:]) > 0
+            except ValueError:
+                return False
+    return False
@@ -0,0 +1,87 @@
+# Copyright 2024 Comcast Cable Communications Management, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+
+"""This file is used to join leases and netwatch entries of a router into one record per device.
+Devices are indexed by address, MAC address, capability and health when the index is built, so filtered
+requests are answered by lookups instead of scans. An index is built once per pair of router replies."""
+
+
+class DeviceIndex:
+
+    def __init__(self, leases, netwatch, capability_index):
+        self.devices = []
+        self.by_address = {}
+        self.by_mac = {}
+        self.by_capability = dict((capability.get('name'), []) for capability in capability_index.capabilities)
+        self.unhealthy = []
+
+        for lease in leases:
+            device = {
+                'address': lease.get('address') or None,
+                'macAddress': lease.get('macAddress'),
+                'comment': lease.get('comment'),
+                'capabilities': [],
+                'leaseStatus': lease.get('status'),
+                'disabled': lease.get('disabled'),
+                'netwatchStatus': None,
+                'since': None,
+            }
+            self.devices.append(device)
+            if device['address']:
+                self.by_address.setdefault(device['address'], device)
+            if device['macAddress']:
+                self.by_mac.setdefault(device['macAddress'].upper(), device)
+
+        # netwatch entries are joined on the address of their host, the ones without a lease become devices
+        for item in netwatch:
+            address = item.get('host')
+            device = self.by_address.get(address)
+            if device is None:
+                device = {'address': address, 'macAddress': None, 'comment': item.get('comment'),
+                          'capabilities': [], 'leaseStatus': None, 'disabled': None}
+                self.devices.append(device)
+                if address:
+                    self.by_address[address] = device
+            device.update({'netwatchStatus': item.get('status'), 'since': item.get('since')})
+
+        for device in self.devices:
+            for position in capability_index.lookup(device['address']):
+                name = capability_index.capabilities[position].get('name')
+                device['capabilities'].append(name)
+                self.by_capability[name].append(device)
+            device['isHealthy'] = device['leaseStatus'] in (None, 'bound') and device['netwatchStatus'] != 'down'
+            if not device['isHealthy']:
+                self.unhealthy.append(device)
+
+    # Return the devices matching every given filter, starting from the narrowest index
+    def find(self, capability=None, unhealthy=False, address=None, mac=None):
+        if address is not None:
+            device = self.by_address.get(address)
+            candidates = [device] if device else []
+        elif mac is not None:
+            device = self.by_mac.get(mac.upper())
+            candidates = [device] if device else []
+        elif capability is not None:
+            candidates = self.by_capability.get(capability, [])
+        elif unhealthy:
+            return list(self.unhealthy)
+        else:
+            return list(self.devices)
+        return [device for device in candidates
+                if (capability is None or capability in device['capabilities'])
+                and (not unhealthy or not device['isHealthy'])
+                and (mac is None or (device['macAddress'] or '').upper() == mac.upper())]
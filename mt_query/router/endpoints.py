@@ -15,78 +15,166 @@
 # SPDX-License-Identifier: Apache-2.0
 
 
+import asyncio
 import logging
+import time
+from werkzeug.exceptions import HTTPException, abort
 from mt_query.router import Router
-from mt_query.router.common import make_camel_case
-from mt_query.router.capability import is_valid, health_check
+from mt_query.router.common import make_camel_case, project_rows
+from mt_query.router.capability import CapabilityIndex, health_check
+from mt_query.router.devices import DeviceIndex
+from mt_query.router.leases import LeaseTable, LeaseView
+from mt_query.router.events import HealthBroker
+from mt_query.model.response import dumps
+from mt_query.router.metrics import timed
 
 from packaging import version
 from mt_query.config import AppConf
+from mt_query.config.watch import FileWatcher
 
 """ This file is used aggregate the data from the router and return it in a format that can be used by the API. """
 
-# Load the configuration files
-capability_file_path = AppConf.get_capability_map_file_path()
-config_file_path = AppConf.get_config_file_path()
+# Set up by start(), the configuration files are only read once the application starts
+capability_index = None
+router = None
+health_broker = None
+config_watcher = FileWatcher()
+# latest device index per host with the replies and capability index it was built from
+device_indexes = {}
 
-AppConf.set('capability_map', AppConf.open(capability_file_path, "capabilities"))
-AppConf.set('credentials', AppConf.open(config_file_path))
-router = Router({})
+
+# Read the configuration files, invalid files raise
+def load_config():
+    AppConf.set('capability_map', AppConf.open(AppConf.get_capability_map_file_path(), "capabilities"))
+    AppConf.set('credentials', AppConf.open(AppConf.get_config_file_path()))
+
+
+def start():
+    global capability_index, router, health_broker
+    load_config()
+    capability_index = CapabilityIndex(AppConf.config('capability_map'))
+    router = Router({})
+    router.queries['capability_leases'] = capability_index.address_query()
+    health_broker = HealthBroker(get_health_view, watch=router.watch, unwatch=router.unwatch)
+    router.follower.listeners.append(lambda host, name, table, change: health_broker.changed(host))
+    router.snapshots.listeners.append(lambda snapshot: health_broker.changed(snapshot.host))
+    router.start()
+
+    config_watcher.add(AppConf.get_capability_map_file_path(), reload_capability_map)
+    config_watcher.add(AppConf.get_config_file_path(), reload_credentials)
+    reload_interval = AppConf.config('credentials').get('reload_interval', 5)
+    if reload_interval:
+        router.scheduler.add_job(check_config, 'interval', seconds=reload_interval, id='config-reload')
+
+
+def shutdown():
+    router.shutdown()
+
+
+# Run on the event loop, so a reload is never seen half done by a request
+async def check_config():
+    config_watcher.check()
+
+
+# Swap in a changed capability map, the index is replaced in one assignment so requests see the old or the new one
+def reload_capability_map(path):
+    global capability_index
+    capability_map = AppConf.open(path, "capabilities")
+    index = CapabilityIndex(capability_map)
+    AppConf.set('capability_map', capability_map)
+    capability_index = index
+    router.queries['capability_leases'] = index.address_query()
+    # leases cached for the old ranges
+    router.cache.invalidate(name='capability_leases')
+    logging.warning(f"reloaded {len(index.capabilities)} capabilities from {path}")
+
+
+def reload_credentials(path):
+    credentials = AppConf.open(path)
+    if not isinstance(credentials, dict):
+        raise ValueError(f"{path} does not hold a mapping of settings")
+    AppConf.set('credentials', credentials)
+    router.reload_credentials(credentials)
+    logging.warning(f"reloaded router access from {path}")
 
 
 """ Start of v1 implementation """
 
 
-def get_aggregate_v1(body):
+async def get_aggregate_v1(body):
     host = body.get('host')
     showDisabled = body.get('showDisabled')
     showDefault = body.get('showDefault')
-    agg = get_aggregate(host, showDisabled, showDefault)
+    agg = await get_aggregate(host, showDisabled, showDefault)
 
-    agg.update({'capability': get_capability_v1(body)})
+    # reuse the capability section fetched with the aggregate instead of querying the router again
+    agg.update({'capability': make_camel_case([agg.get('capability')], body.get('capabilities'))})
     return agg
 
 
-def get_capability_v1(body):
+async def get_capability_v1(body):
     keys = body.get('capabilities')
     showDisabled = body.get('showDisabled')
     showDefault = body.get('showDefault')
     host = body.get('host')
-    capabilities = get_capability(host, showDisabled, showDefault)
+    capabilities = await get_capability(host, showDisabled, showDefault)
     return make_camel_case([capabilities], keys)
 
 
 """ Start of v2 implementation """
 
 
-def get_aggregate(host, showDisabled, showDefault):
+async def get_aggregate(host, showDisabled, showDefault, max_age=None, fresh=False, conditional=None):
+    # all sections are fetched over a single router session
+    calls = await router.get_aggregate(host, max_age, fresh)
+    if conditional:
+        conditional.check(calls, 'aggregate', showDisabled, showDefault, capability_index.fingerprint)
+    leases = format_leases(calls.get('leases'))
     agg = {}
-    agg.update({'identity': get_identity(host)})
-    agg.update({'firmware': get_firmware(host)})
-    agg.update({'capability': get_capability(host, showDisabled, showDefault)})
-    agg.update({'leases': get_leases(host)})
-    agg.update({'netwatch': get_netwatch(host)})
+    agg.update({'identity': format_identity(calls.get('identity'))})
+    agg.update({'firmware': format_firmware(calls.get('firmware'))})
+    agg.update({'capability': build_capability(leases, showDisabled, showDefault)})
+    agg.update({'leases': leases})
+    agg.update({'netwatch': format_netwatch(calls.get('netwatch'))})
     return agg
 
 
-def get_identity(host):
-    call = router.get_identity(host)
+async def get_identity(host, max_age=None, fresh=False, conditional=None):
+    call = await router.get_identity(host, max_age, fresh)
+    if conditional:
+        conditional.check({'identity': call})
+    return format_identity(call)
+
+
+def format_identity(call):
     response = (make_camel_case(call))
     return response
 
 
-def get_capability(host, showDisabled=False, showDefault=False, filter=None):
+async def get_capability(host, showDisabled=False, showDefault=False, filter=None, max_age=None, fresh=False,
+                         conditional=None):
+    # the router only returns leases inside the capability ranges
+    call = await router.get_capability_leases(host, max_age, fresh)
+    if conditional:
+        conditional.check({'leases': call}, 'capability', showDisabled, showDefault, capability_index.fingerprint)
+    return build_capability(format_leases(call), showDisabled, showDefault)
+
+
+@timed('build_capability')
+def build_capability(leases, showDisabled=False, showDefault=False):
     options = {'showDisabled': showDisabled, 'showDefault': showDefault}
-    leases = get_leases(host)
+    # classify each lease once against the compiled capability ranges
+    # capabilities refer to the leases by position instead of holding copies
+    matches = [LeaseView(leases) for _ in capability_index.capabilities]
+    for i, lease in enumerate(leases):
+        for position in capability_index.lookup(lease.address):
+            if capability_index.accepts(lease, position, options):
+                matches[position].append(i)
+
     cap_dict = {}
-    capabilities_map = AppConf.config('capability_map')
-    for capability in capabilities_map:
+    for capability, matching_leases in zip(capability_index.capabilities, matches):
         cap_name = capability.get('name')
         cap_dict.update({cap_name: {}})
-        matching_leases = []
-        for lease in leases:
-            if is_valid(lease, capability, options):
-                matching_leases.append(lease)
         if matching_leases:
             obj_body = {'metadata': matching_leases, 'isHealthy': health_check(matching_leases)}
             cap_dict[cap_name].update(obj_body)
@@ -94,10 +182,16 @@ def get_capability(host, showDisabled=False, showDefault=False, filter=None):
     return cap_dict
 
 
-def get_firmware(host):
+async def get_firmware(host, max_age=None, fresh=False, conditional=None):
+    call = await router.get_firmware(host, max_age, fresh)
+    if conditional:
+        conditional.check({'firmware': call})
+    return format_firmware(call)
+
+
+def format_firmware(call):
     response = {'metaData': None, 'isHealthy': None}
-    keys = ('factory-firmware', 'current-firmware', 'upgrade-firmware')
-    call = router.get_firmware(host)
+    keys = Router.columns['firmware']
     firmware_meta = make_camel_case(call, keys)
     current = version.parse(firmware_meta.get('currentFirmware'))
     response['metaData'] = firmware_meta
@@ -106,34 +200,187 @@ def get_firmware(host):
     return response
 
 
-def get_leases(host):
-    keys = ('comment', 'address', 'mac-address', 'status', 'disabled', 'last-seen')
-    call = router.get_leases(host)
-    response = make_camel_case(call, keys)
-    for lease in response:
-        lease.update({'isHealthy': lease.get('status') == 'bound'})
-        if not lease.get('address'):
-            lease['address'] = ""
-    return response
+async def get_leases(host, max_age=None, fresh=False, conditional=None):
+    call = await router.get_leases(host, max_age, fresh)
+    if conditional:
+        conditional.check({'leases': call})
+    return format_leases(call)
+
+
+# Leases are kept as compact records, formatted when the response is written
+def format_leases(call):
+    return LeaseTable.of(call)
 
 
-def get_netwatch(host):
-    keys = ('comment', 'host', 'status', 'since')
-    call = router.get_netwatch(host)
-    response = make_camel_case(call, keys)
+async def get_netwatch(host, max_age=None, fresh=False, conditional=None):
+    call = await router.get_netwatch(host, max_age, fresh)
+    if conditional:
+        conditional.check({'netwatch': call})
+    return format_netwatch(call)
+
+
+def format_netwatch(call):
+    keys = Router.columns['netwatch']
+    response = project_rows(call, keys)
     return response
 
 
 # v3
 
-def get_aggregate_v3(host, showDisabled, showDefault):
-    agg = {}
-    agg.update({'identity': get_identity(host)})
-    agg.update({'firmware': get_firmware(host)})
-    agg.update({'capability': get_capability(host, showDisabled, showDefault)})
-    agg.update({'leases': get_leases(host)})
-    agg.update({'netwatch': get_netwatch(host)})
-    return agg
+async def get_aggregate_v3(host, showDisabled, showDefault, max_age=None, fresh=False, conditional=None):
+    return await get_aggregate(host, showDisabled, showDefault, max_age, fresh, conditional)
+
+
+# fleet
+
+def get_fleet(hosts=None, group=None, showDisabled=False, showDefault=False, concurrency=None, timeout=None,
+              max_age=None, fresh=False):
+    fleet_conf = AppConf.config('credentials').get('fleet') or {}
+    targets = list(hosts or [])
+    if group:
+        groups = AppConf.config('credentials').get('groups') or {}
+        if group not in groups:
+            abort(404, f"Unknown router group: {group}")
+        targets.extend(groups[group])
+    # keep request order but query every router only once
+    targets = list(dict.fromkeys(targets))
+    if not targets:
+        abort(400, "No hosts or group given.")
+    concurrency = concurrency or fleet_conf.get('concurrency', 16)
+    timeout = timeout or fleet_conf.get('timeout', 10)
+    return _stream_fleet(targets, showDisabled, showDefault, concurrency, timeout, max_age, fresh)
+
+
+async def _stream_fleet(hosts, showDisabled, showDefault, concurrency, timeout, max_age, fresh):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def query(host):
+        async with semaphore:
+            started = time.monotonic()
+            result = {'host': host}
+            result.update(await _guarded(host, get_aggregate(host, showDisabled, showDefault, max_age, fresh),
+                                         timeout, 'aggregate'))
+            result.update({'elapsed': round(time.monotonic() - started, 3)})
+            return result
+
+    tasks = [asyncio.ensure_future(query(host)) for host in hosts]
+    try:
+        # every router is written out as soon as it answers
+        for task in asyncio.as_completed(tasks):
+            yield dumps(await task) + b'\n'
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+# Await a call for one router of a multi-router request, returning its value under key or an error object
+async def _guarded(host, call, timeout, key):
+    try:
+        return {key: await asyncio.wait_for(call, timeout)}
+    except HTTPException as e:
+        return {'error': {'status': e.code, 'message': e.description}}
+    except asyncio.TimeoutError:
+        return {'error': {'status': 504, 'message': f"No reply from {host} within {timeout}s"}}
+    except Exception as e:
+        logging.warning(f"query for {host} failed with {str(e)}")
+        return {'error': {'status': 500, 'message': str(e)}}
+
+
+async def get_capability_batch(queries, concurrency=None, timeout=None, max_age=None, fresh=False):
+    fleet_conf = AppConf.config('credentials').get('fleet') or {}
+    concurrency = concurrency or fleet_conf.get('concurrency', 16)
+    timeout = timeout or fleet_conf.get('timeout', 10)
+    semaphore = asyncio.Semaphore(concurrency)
+    started = time.monotonic()
+
+    # leases are fetched and formatted once per router, however many queries name it
+    async def fetch(host):
+        async with semaphore:
+            reply = await _guarded(host, router.get_capability_leases(host, max_age, fresh), timeout, 'leases')
+        if 'leases' in reply:
+            reply['leases'] = format_leases(reply['leases'])
+        reply['elapsed'] = round(time.monotonic() - started, 3)
+        return reply
+
+    hosts = list(dict.fromkeys(query.get('host') or router.host for query in queries))
+    leases = dict(zip(hosts, await asyncio.gather(*(fetch(host) for host in hosts))))
+
+    results = []
+    built = {}
+    for query in queries:
+        host = query.get('host') or router.host
+        reply = leases[host]
+        result = {'host': host}
+        if 'error' in reply:
+            result.update({'error': reply['error']})
+        else:
+            # queries that only differ in the capabilities they select share one classification
+            options = (host, bool(query.get('showDisabled')), bool(query.get('showDefault')))
+            if options not in built:
+                built[options] = build_capability(reply['leases'], *options[1:])
+            capability = built[options]
+            names = query.get('capabilities')
+            if names:
+                capability = dict((name, capability.get(name)) for name in names)
+            result.update({'capability': capability})
+        result.update({'elapsed': reply['elapsed']})
+        results.append(result)
+    return {'results': results, 'elapsed': round(time.monotonic() - started, 3)}
+
+
+# health events
+
+def get_health_view(host):
+    # computed from local data only, so change events never cause router traffic
+    calls = router.local_calls(['leases', 'netwatch'], host)
+    if 'leases' not in calls or 'netwatch' not in calls:
+        return None
+    leases = format_leases(calls.get('leases'))
+    capability = build_capability(leases)
+    return {
+        'capability': dict((name, cap.get('isHealthy')) for name, cap in capability.items()),
+        'leases': dict((lease.get('address') or lease.get('macAddress'), lease.get('status')) for lease in leases),
+        'netwatch': dict((item.get('host'), item.get('status')) for item in format_netwatch(calls.get('netwatch'))),
+    }
+
+
+def get_health_events(host):
+    return health_broker.stream(host or router.host)
+
+
+async def get_devices(host, capability=None, unhealthy=False, address=None, mac=None, max_age=None, fresh=False,
+                      conditional=None):
+    host = host or router.host
+    calls = await router.cached_calls(['leases', 'netwatch'], host, max_age, fresh)
+    if conditional:
+        conditional.check(calls, 'devices', capability, unhealthy, address, mac, capability_index.fingerprint)
+    index = device_index(host, calls)
+    if capability is not None and capability not in index.by_capability:
+        abort(404, f"Unknown capability: {capability}")
+    return index.find(capability, unhealthy, address, mac)
+
+
+# Return the device index of a host, only rebuilt when the router replies or the capability map change
+def device_index(host, calls):
+    leases, netwatch = calls.get('leases'), calls.get('netwatch')
+    entry = device_indexes.get(host)
+    if entry and entry[0] is leases and entry[1] is netwatch and entry[2] is capability_index:
+        return entry[3]
+    index = DeviceIndex(format_leases(leases), format_netwatch(netwatch), capability_index)
+    device_indexes[host] = (leases, netwatch, capability_index, index)
+    return index
+
+
+def get_history(host, window=3600, kind=None):
+    host = host or router.host
+    if host not in router.history.hosts():
+        if not router.leader.held and router.cache.shared is None:
+            abort(503, "Status history is only kept by the leader worker, set cluster shared_cache to serve it "
+                       "from every worker")
+        abort(404, f"No status history for host: {host}, only polled and followed routers are recorded")
+    history = {'host': host, 'window': window}
+    history.update(router.history.summary(host, window, [kind] if kind else None))
+    return history
 
 
 def post_config_backup():
@@ -147,3 +394,37 @@ def get_config_backup():
     logging.info(f"returned backup info size {len(reply)}.")
     logging.debug(f"File info: {reply}")
     return reply
+
+
+# Return the stored version of a host with the given id, or its latest version
+def _backup_version(host, version_id=None):
+    # host names come from the request, only hosts with stored backups are looked up on disk
+    if host not in router.backups.hosts():
+        abort(404, f"No config backups for host: {host}")
+    versions = router.backups.versions(host)
+    if version_id is None:
+        return versions[-1], versions
+    version = next((version for version in versions if version['id'] == version_id), None)
+    if version is None:
+        abort(404, f"No config backup {version_id} for host: {host}")
+    return version, versions
+
+
+def get_backup(host, version_id=None):
+    version, _ = _backup_version(host, version_id)
+    return router.backups.object_path(host, version['digest']), f"{host}-{version['id']}.rsc"
+
+
+async def get_backup_diff(host, from_id=None, to_id=None):
+    to_version, versions = _backup_version(host, to_id)
+    if from_id is None:
+        position = versions.index(to_version)
+        if not position:
+            abort(404, f"No config backup before {to_version['id']} for host: {host}")
+        from_version = versions[position - 1]
+    else:
+        from_version, _ = _backup_version(host, from_id)
+    # diffing reads both versions from disk, keep it off the event loop
+    path = await asyncio.to_thread(router.backups.diff, host, from_version, to_version)
+    return path, f"{host}-{from_version['id']}..{to_version['id']}.diff"
+
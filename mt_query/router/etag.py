@@ -0,0 +1,100 @@
+# Copyright 2024 Comcast Cable Communications Management, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+
+import hashlib
+from collections import OrderedDict
+
+from mt_query.model.response import dumps
+
+"""This file is used to answer conditional requests.
+ETags are computed from the router data a response is built from, before it is formatted, so an unchanged
+response costs neither formatting nor serialization."""
+
+
+class NotModified(Exception):
+
+    def __init__(self, etag):
+        super().__init__(etag)
+        self.etag = etag
+
+
+class RowDigests:
+    """Digests of router replies, remembered per reply object.
+
+    Replies held by the cache, poller snapshots and followed tables are replaced rather than modified, so the
+    same object always has the same digest. Each remembered reply is referenced until it is dropped, which
+    keeps its id from being reused by another object."""
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._digests = OrderedDict()
+
+    def digest(self, rows):
+        key = id(rows)
+        entry = self._digests.get(key)
+        if entry is not None and entry[0] is rows:
+            self._digests.move_to_end(key)
+            return entry[1]
+        digest = hashlib.blake2b(dumps(rows), digest_size=16).digest()
+        self._digests[key] = (rows, digest)
+        if len(self._digests) > self.max_entries:
+            self._digests.popitem(last=False)
+        return digest
+
+
+row_digests = RowDigests()
+
+
+def make_etag(calls, *params):
+    etag = hashlib.blake2b(repr(params).encode(), digest_size=16)
+    for name in sorted(calls):
+        etag.update(name.encode())
+        etag.update(row_digests.digest(calls[name]))
+    # weak, the same data is sent with different content codings
+    return f'W/"{etag.hexdigest()}"'
+
+
+# Weak comparison as used for If-None-Match
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    opaque = etag[2:] if etag.startswith('W/') else etag
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if (candidate[2:] if candidate.startswith('W/') else candidate) == opaque:
+            return True
+    return False
+
+
+class Conditional:
+    """The If-None-Match header of a request and the ETag of its response."""
+
+    def __init__(self, if_none_match=None):
+        self.if_none_match = if_none_match
+        self.etag = None
+
+    # Record the ETag of the data a response is built from, raise NotModified if the client already has it
+    def check(self, calls, *params):
+        self.etag = make_etag(calls, *params)
+        if etag_matches(self.if_none_match, self.etag):
+            raise NotModified(self.etag)
+
+    @property
+    def headers(self):
+        return {'ETag': self.etag} if self.etag else None
@@ -0,0 +1,127 @@
+# Copyright 2024 Comcast Cable Communications Management, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+
+import asyncio
+import json
+import logging
+
+"""This file is used to push health changes to subscribed clients as server-sent events.
+Each change is diffed and encoded once per host and the same message is handed to every subscriber."""
+
+
+def diff_views(old, new):
+    """Return the entries of each section that changed or disappeared between two views."""
+    changes = {}
+    for section, entries in new.items():
+        previous = old.get(section) or {}
+        changed = dict((key, value) for key, value in entries.items()
+                       if key not in previous or previous[key] != value)
+        removed = [key for key in previous if key not in entries]
+        if changed or removed:
+            changes[section] = {'changed': changed, 'removed': removed}
+    return changes
+
+
+def sse_message(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class HealthBroker:
+
+    def __init__(self, view, watch=None, unwatch=None, queue_size=64):
+        # view is called with a host and returns its current {section: {key: value}} state, or None if unknown
+        self.view = view
+        self.watch = watch
+        self.unwatch = unwatch
+        self.queue_size = queue_size
+        self._views = {}
+        self._versions = {}
+        self._subscribers = {}
+        self._pending = set()
+
+    def subscribe(self, host):
+        queue = asyncio.Queue(self.queue_size)
+        subscribers = self._subscribers.setdefault(host, set())
+        if not subscribers and self.watch:
+            self.watch(host)
+        subscribers.add(queue)
+        if host in self._views:
+            queue.put_nowait(self._snapshot_message(host))
+        else:
+            self._refresh(host)
+        return queue
+
+    def unsubscribe(self, host, queue):
+        subscribers = self._subscribers.get(host) or set()
+        subscribers.discard(queue)
+        if not subscribers:
+            self._subscribers.pop(host, None)
+            self._views.pop(host, None)
+            if self.unwatch:
+                self.unwatch(host)
+
+    # Called whenever data for the host changed; bursts within one loop iteration are diffed once
+    def changed(self, host):
+        if host not in self._subscribers or host in self._pending:
+            return
+        self._pending.add(host)
+        asyncio.get_running_loop().call_soon(self._refresh, host)
+
+    def _refresh(self, host):
+        self._pending.discard(host)
+        if host not in self._subscribers:
+            return
+        try:
+            view = self.view(host)
+        except Exception as e:
+            logging.warning(f"computing health view for {host} failed with {str(e)}")
+            return
+        if view is None:
+            return
+        previous = self._views.get(host)
+        self._views[host] = view
+        if previous is None:
+            self._publish(host, self._snapshot_message(host))
+            return
+        changes = diff_views(previous, view)
+        if changes:
+            self._versions[host] = self._versions.get(host, 0) + 1
+            self._publish(host, sse_message('diff', dict(host=host, version=self._versions[host], **changes)))
+
+    def _snapshot_message(self, host):
+        return sse_message('snapshot', dict(host=host, version=self._versions.get(host, 0), **self._views[host]))
+
+    def _publish(self, host, message):
+        for queue in list(self._subscribers.get(host) or ()):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # a subscriber that cannot keep up is resynced with a full snapshot instead of missing diffs
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(self._snapshot_message(host))
+
+    async def stream(self, host, keepalive=15):
+        queue = self.subscribe(host)
+        try:
+            while True:
+                try:
+                    yield await asyncio.wait_for(queue.get(), keepalive)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+        finally:
+            self.unsubscribe(host, queue)
@@ -0,0 +1,201 @@
+# Copyright 2024 Comcast Cable Communications Management, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+
+import asyncio
+import logging
+import time
+from functools import partial
+
+"""This file is used to keep local copies of router tables up to date from RouterOS listen subscriptions.
+A full print is loaded once per session and only the changes are received after that. Only the leader
+process follows, the other workers are handed the tables through the shared cache."""
+
+# Tables that can be followed, keyed by the name used in Router.commands
+FOLLOWED_TABLES = {
+    'leases': '/ip/dhcp-server/lease',
+    'netwatch': '/tool/netwatch',
+}
+
+
+class FollowTable:
+
+    def __init__(self, convert=None):
+        self.rows = {}
+        self.version = 0
+        # turns the rows into the form replies are kept in, e.g. lease records
+        self.convert = convert
+        self._value = None
+        self.synced = False
+        self._listing = []
+        # changes received before the full load, applied on top of it
+        self._pending = []
+
+    def reset(self):
+        self.synced = False
+        self._pending = []
+
+    def load(self, rows):
+        self.rows = dict((row.get('.id'), row) for row in rows)
+        pending, self._pending = self._pending, []
+        for row in pending:
+            self._merge(row)
+        self.synced = True
+        self._changed()
+
+    # Apply a change, return the replaced and the new row (None if removed), or None if the table did not change.
+    # Changes before the full load are held back
+    def apply(self, row):
+        if not self.synced:
+            self._pending.append(row)
+            return None
+        change = self._merge(row)
+        if change is not None:
+            self._changed()
+        return change
+
+    def _merge(self, row):
+        row_id = row.get('.id')
+        if row.get('.dead'):
+            previous = self.rows.pop(row_id, None)
+            return None if previous is None else (previous, None)
+        # listen replies carry the whole item, merge anyway in case a property was left out
+        previous = self.rows.get(row_id)
+        self.rows[row_id] = dict(previous or {}, **row)
+        return previous, self.rows[row_id]
+
+    def _changed(self):
+        self.version += 1
+        self._listing = None
+        self._value = None
+
+    def list(self):
+        if self._listing is None:
+            self._listing = list(self.rows.values())
+        return self._listing
+
+    # Return the rows in the form replies are kept in, converted once per version
+    def value(self):
+        if self._value is None:
+            self._value = self.convert(self.list()) if self.convert else self.list()
+        return self._value
+
+
+class Follower:
+
+    def __init__(self, router, hosts=None, reconnect_delay=5, max_reconnect_delay=300, publish_interval=1):
+        self.router = router
+        self.hosts = list(hosts or [])
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        # how often changed tables are handed to the other workers
+        self.publish_interval = publish_interval
+        self._published = {}
+        convert = router.cache.convert
+        self.tables = dict((host, dict((name, FollowTable(partial(convert, name) if convert else None))
+                                       for name in FOLLOWED_TABLES)) for host in self.hosts)
+        # called with host, table name, table and the change after every change, the change is None after a
+        # full load and the replaced and new row (either may be None) otherwise
+        self.listeners = []
+        self._tasks = []
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self.run(host)) for host in self.hosts]
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    # Return whether this process keeps the tables of a host current
+    def following(self, host):
+        return bool(self._tasks) and host in self.hosts
+
+    def schedule(self, scheduler):
+        scheduler.add_job(self.publish, 'interval', seconds=self.publish_interval, id='follow-publish',
+                          coalesce=True, max_instances=1, replace_existing=True)
+
+    # Store changed tables in the cache, and unchanged ones again before the other workers consider them expired
+    async def publish(self):
+        cache = self.router.cache
+        now = time.monotonic()
+        for host, tables in self.tables.items():
+            for name, table in tables.items():
+                version, published = self._published.get((host, name), (None, 0))
+                if not table.synced or (version == table.version and
+                                        now - published < cache.ttl.get(name, cache.default_ttl) / 2):
+                    continue
+                cache.publish(host, name, table.value())
+                self._published[(host, name)] = table.version, now
+
+    # Return the rows of every requested table that is followed and in sync for the host
+    def lookup(self, host, names):
+        tables = self.tables.get(host) or {}
+        return dict((name, tables[name].value()) for name in names if name in tables and tables[name].synced)
+
+    async def run(self, host):
+        delay = self.reconnect_delay
+        while True:
+            try:
+                await self._follow(host)
+            except Exception as e:
+                # a session that got in sync starts the backoff over
+                if all(table.synced for table in self.tables[host].values()):
+                    delay = self.reconnect_delay
+                logging.warning(f"following tables on {host} failed with {str(e)}, retrying in {delay}s")
+            finally:
+                # a full resync is needed after any reconnect
+                for table in self.tables[host].values():
+                    table.reset()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_reconnect_delay)
+
+    async def _follow(self, host):
+        # a dedicated session, listen commands never complete so they would hold a pooled one forever
+        connection = await self.router.login(host)
+        try:
+            # subscribe before the full load, changes in between are held back by the table and applied after it
+            subscriptions = [(name, path, await connection.send(f'{path}/listen'))
+                             for name, path in FOLLOWED_TABLES.items()]
+            listens = [asyncio.ensure_future(self._listen(connection, host, name, path, *subscription))
+                       for name, path, subscription in subscriptions]
+            try:
+                for name, path in FOLLOWED_TABLES.items():
+                    self.tables[host][name].load(await connection(f'{path}/print'))
+                    self._notify(host, name, None)
+                logging.info(f"following {', '.join(FOLLOWED_TABLES)} on {host}")
+                await asyncio.gather(*listens)
+            finally:
+                for listen in listens:
+                    listen.cancel()
+        finally:
+            connection.close()
+
+    async def _listen(self, connection, host, name, path, tag, queue):
+        table = self.tables[host][name]
+        async for row in connection.replies(tag, queue):
+            change = table.apply(row)
+            if change is not None:
+                self._notify(host, name, change)
+        raise ConnectionError(f"listen on {path} ended")
+
+    def _notify(self, host, name, change):
+        for listener in self.listeners:
+            try:
+                listener(host, name, self.tables[host][name], change)
+            except Exception as e:
+                logging.warning(f"follow listener failed with {str(e)}")
@@ -0,0 +1,175 @@
+# Copyright 2024 Comcast Cable Communications Management, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+
+from array import array
+from bisect import bisect_right
+import datetime as dt
+import logging
+import time
+
+"""This file is used to keep a bounded history of lease and netwatch status per router.
+Every lease (by address) and netwatch entry (by host) has a ring buffer of (timestamp, state) samples in
+typed arrays, holding a sample whenever the state changes. Uptime, flap counts and last transitions over a
+window are computed from these samples."""
+
+DOWN = 0
+UP = 1
+# no longer listed by the router
+ABSENT = -1
+
+STATE_NAMES = {DOWN: 'down', UP: 'up', ABSENT: 'absent'}
+
+
+def lease_state(row):
+    return UP if row.get('status') == 'bound' else DOWN
+
+
+def netwatch_state(row):
+    return UP if row.get('status') == 'up' else DOWN
+
+
+# table name: (key column, state of a row)
+TRACKED = {
+    'leases': (lambda row: row.get('address') or row.get('mac-address'), lease_state),
+    'netwatch': (lambda row: row.get('host'), netwatch_state),
+}
+
+
+class Ring:
+    """Samples of one entry, 9 bytes each, oldest overwritten once capacity is reached."""
+    __slots__ = ('times', 'states', 'start')
+
+    def __init__(self):
+        self.times = array('d')
+        self.states = array('b')
+        # position of the oldest sample once the ring is full
+        self.start = 0
+
+    @property
+    def state(self):
+        return self.states[self.start - 1]
+
+    def add(self, timestamp, state, capacity):
+        # samples from different sources may arrive out of order, the window statistics need them sorted
+        if self.times:
+            timestamp = max(timestamp, self.times[self.start - 1])
+        if len(self.times) < capacity:
+            self.times.append(timestamp)
+            self.states.append(state)
+            return
+        self.times[self.start] = timestamp
+        self.states[self.start] = state
+        self.start = (self.start + 1) % capacity
+
+    # Return the samples oldest first
+    def ordered(self):
+        if not self.start:
+            return self.times, self.states
+        return self.times[self.start:] + self.times[:self.start], self.states[self.start:] + self.states[:self.start]
+
+    def summary(self, since, now):
+        times, states = self.ordered()
+        # the sample in effect at the start of the window, or the first one if it is younger
+        first = max(bisect_right(times, since) - 1, 0)
+        begin = max(times[first], since)
+        up = 0.0
+        for i in range(first, len(times)):
+            if states[i] == UP:
+                end = times[i + 1] if i + 1 < len(times) else now
+                up += end - max(times[i], begin)
+        observed = now - begin
+        return {
+            'status': STATE_NAMES[states[-1]],
+            'uptime': round(100 * up / observed, 2) if observed > 0 else (100.0 if states[-1] == UP else 0.0),
+            # every sample after the first one in the window is a change of state
+            'flaps': len(times) - 1 - first,
+            'lastTransition': iso_time(times[-1]) if len(times) > 1 else None,
+            'observedSince': iso_time(begin),
+        }
+
+
+def iso_time(timestamp):
+    return dt.datetime.fromtimestamp(timestamp, dt.timezone.utc).isoformat(timespec='seconds')
+
+
+class StatusHistory:
+
+    def __init__(self, capacity=128, max_entries=4096):
+        # samples kept per entry and entries kept per host and table, bounding memory to about
+        # 9 * capacity * max_entries bytes per host and table
+        self.capacity = capacity
+        self.max_entries = max_entries
+        self._rings = {}
+
+    # Record the state of every row of the given tables, entries missing from a table become absent
+    def record(self, host, tables, timestamp=None):
+        timestamp = timestamp or time.time()
+        for name, rows in tables.items():
+            if name not in TRACKED or rows is None:
+                continue
+            key_of, state_of = TRACKED[name]
+            rings = self._rings.setdefault((host, name), {})
+            seen = set()
+            for row in rows:
+                key = key_of(row)
+                if not key:
+                    continue
+                seen.add(key)
+                self._add(rings, host, name, key, state_of(row), timestamp)
+            for key, ring in rings.items():
+                if key not in seen and ring.state != ABSENT:
+                    ring.add(timestamp, ABSENT, self.capacity)
+
+    # Record one changed row of a table, previous being the row it replaced and row None if it was removed
+    def record_change(self, host, name, previous, row, timestamp=None):
+        if name not in TRACKED:
+            return
+        timestamp = timestamp or time.time()
+        key_of, state_of = TRACKED[name]
+        rings = self._rings.setdefault((host, name), {})
+        key = key_of(row) if row is not None else None
+        if key:
+            self._add(rings, host, name, key, state_of(row), timestamp)
+        # a removed row, or one whose key changed, leaves its old entry absent
+        previous_key = key_of(previous) if previous is not None else None
+        ring = rings.get(previous_key) if previous_key and previous_key != key else None
+        if ring is not None and ring.state != ABSENT:
+            ring.add(timestamp, ABSENT, self.capacity)
+
+    def _add(self, rings, host, name, key, state, timestamp):
+        ring = rings.get(key)
+        if ring is None:
+            if len(rings) >= self.max_entries:
+                logging.debug(f"not keeping {name} history of {key} on {host}, {self.max_entries} entries reached")
+                return
+            ring = rings[key] = Ring()
+        elif ring.state == state:
+            return
+        ring.add(timestamp, state, self.capacity)
+
+    def hosts(self):
+        return sorted(set(host for host, _ in self._rings))
+
+    # Return the statistics of every entry of a host over the last window seconds, per table
+    def summary(self, host, window, names=None, now=None):
+        now = now or time.time()
+        since = now - window
+        result = {}
+        for name in names or TRACKED:
+            rings = self._rings.get((host, name)) or {}
+            result[name] = dict((key, ring.summary(since, now)) for key, ring in rings.items())
+        return result
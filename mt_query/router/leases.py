@@ -0,0 +1,168 @@
+# Copyright 2024 Comcast Cable Communications Management, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+
+from array import array
+import re
+
+from mt_query.router.common import int_to_ip, ip_to_int
+
+"""This file is used to hold DHCP lease tables compactly.
+Leases are stored as slotted records with the address and MAC address as integers and the status as a small
+code, instead of one dict of strings per lease. Capabilities refer to leases by position in their table.
+Records are turned into JSON objects only when a response is serialized."""
+
+# RouterOS lease statuses, other values are added as they are seen
+STATUS_NAMES = ['waiting', 'testing', 'authorizing', 'busy', 'offered', 'bound']
+STATUS_CODES = dict((name, code) for code, name in enumerate(STATUS_NAMES))
+BOUND = STATUS_CODES['bound']
+NO_STATUS = -1
+
+LEASE_TABLES = ('leases', 'capability_leases')
+
+# the form RouterOS sends, other spellings are kept as text so they are returned unchanged
+MAC_PATTERN = re.compile(r'[0-9A-F]{2}(?::[0-9A-F]{2}){5}')
+
+
+def status_code(name):
+    if name is None:
+        return NO_STATUS
+    code = STATUS_CODES.get(name)
+    if code is None:
+        code = STATUS_CODES[name] = len(STATUS_NAMES)
+        STATUS_NAMES.append(name)
+    return code
+
+
+def mac_to_int(mac):
+    if mac and MAC_PATTERN.fullmatch(mac):
+        return int(mac.replace(':', ''), 16)
+    return mac
+
+
+def int_to_mac(value):
+    return value.to_bytes(6, 'big').hex(':').upper()
+
+
+class Lease:
+    __slots__ = ('address', 'mac', 'status', 'disabled', 'comment', 'last_seen')
+
+    def __init__(self, row):
+        address = row.get('address')
+        ip = ip_to_int(address) if address else None
+        self.address = address if ip is None else ip
+        self.mac = mac_to_int(row.get('mac-address'))
+        self.status = status_code(row.get('status'))
+        self.disabled = row.get('disabled')
+        self.comment = row.get('comment')
+        self.last_seen = row.get('last-seen')
+
+    @property
+    def address_text(self):
+        return int_to_ip(self.address) if isinstance(self.address, int) else self.address
+
+    @property
+    def mac_text(self):
+        return int_to_mac(self.mac) if isinstance(self.mac, int) else self.mac
+
+    @property
+    def status_name(self):
+        return None if self.status == NO_STATUS else STATUS_NAMES[self.status]
+
+    # Look up a value by RouterOS column or by its name in responses, like on a reply row or formatted lease
+    def get(self, key, default=None):
+        getter = LEASE_KEYS.get(key)
+        value = getter(self) if getter else None
+        return default if value is None else value
+
+    # The lease as returned by the API
+    def as_json(self):
+        address, mac, status = self.address, self.mac, self.status
+        return {
+            'comment': self.comment,
+            'address': (int_to_ip(address) if isinstance(address, int) else address) or "",
+            'macAddress': int_to_mac(mac) if isinstance(mac, int) else mac,
+            'status': None if status == NO_STATUS else STATUS_NAMES[status],
+            'disabled': self.disabled,
+            'lastSeen': self.last_seen,
+            'isHealthy': self.status == BOUND,
+        }
+
+    # The lease as RouterOS sends it, for storing outside the process
+    def as_row(self):
+        return {
+            'comment': self.comment,
+            'address': self.address_text,
+            'mac-address': self.mac_text,
+            'status': self.status_name,
+            'disabled': self.disabled,
+            'last-seen': self.last_seen,
+        }
+
+
+LEASE_KEYS = {
+    'address': lambda lease: lease.address_text,
+    'mac-address': lambda lease: lease.mac_text,
+    'macAddress': lambda lease: lease.mac_text,
+    'status': lambda lease: lease.status_name,
+    'disabled': lambda lease: lease.disabled,
+    'comment': lambda lease: lease.comment,
+    'last-seen': lambda lease: lease.last_seen,
+    'lastSeen': lambda lease: lease.last_seen,
+    'isHealthy': lambda lease: lease.status == BOUND,
+}
+
+
+class LeaseTable(list):
+    """Leases of one router reply. A list, so it is serialized as a JSON array of its leases."""
+
+    @classmethod
+    def of(cls, rows):
+        if isinstance(rows, cls):
+            return rows
+        return cls(Lease(row) for row in rows or ())
+
+
+class LeaseView:
+    """Leases of a table picked by position, e.g. the leases of one capability."""
+    __slots__ = ('table', 'positions')
+
+    def __init__(self, table, positions=()):
+        self.table = table
+        self.positions = array('l', positions)
+
+    def append(self, position):
+        self.positions.append(position)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __iter__(self):
+        return (self.table[position] for position in self.positions)
+
+    def __getitem__(self, index):
+        return self.table[self.positions[index]]
+
+    def as_json(self):
+        return [self.table[position].as_json() for position in self.positions]
+
+
+# Store lease replies as LeaseTables, other replies are kept as they are
+def compact(name, value):
+    if name in LEASE_TABLES and value is not None:
+        return LeaseTable.of(value)
+    return value
+
@@ -0,0 +1,132 @@
+# Copyright 2024 Comcast Cable Communications Management, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+
+import datetime as dt
+import time
+
+from apscheduler.events import EVENT_JOB_SUBMITTED
+from prometheus_client import Counter, Gauge, Histogram
+from starlette.routing import Match
+
+"""This file is used to define the Prometheus metrics of the service, exposed on /metrics.
+Router metrics are labelled by host and command so that slow routers stand out under load."""
+
+ROUTER_LOGIN_SECONDS = Histogram(
+    'mtquery_router_login_seconds', 'Time to connect and log into a router.', ['host'])
+ROUTER_LOGINS = Counter(
+    'mtquery_router_logins_total', 'Router logins by result.', ['host', 'result'])
+ROUTER_COMMAND_SECONDS = Histogram(
+    'mtquery_router_command_seconds', 'RouterOS API command latency.', ['host', 'command'])
+ROUTER_COMMAND_ERRORS = Counter(
+    'mtquery_router_command_errors_total', 'Failed RouterOS API commands by kind of failure.',
+    ['host', 'command', 'kind'])
+ROUTER_COMMAND_ROWS = Gauge(
+    'mtquery_router_command_rows', 'Rows in the latest reply to a command.', ['host', 'command'])
+ROUTER_CIRCUIT_OPEN = Gauge(
+    'mtquery_router_circuit_open', 'Whether requests to a router are being failed fast after repeated errors.',
+    ['host'])
+
+# Router metrics by their label names, the series of a router are removed when it is forgotten
+ROUTER_SERIES = (
+    (ROUTER_LOGIN_SECONDS, ('host',)),
+    (ROUTER_LOGINS, ('host', 'result')),
+    (ROUTER_COMMAND_SECONDS, ('host', 'command')),
+    (ROUTER_COMMAND_ERRORS, ('host', 'command', 'kind')),
+    (ROUTER_COMMAND_ROWS, ('host', 'command')),
+    (ROUTER_CIRCUIT_OPEN, ('host',)),
+)
+
+
+def forget_host(host):
+    for metric, names in ROUTER_SERIES:
+        series = set(tuple(sample.labels[name] for name in names)
+                     for family in metric.collect() for sample in family.samples if sample.labels.get('host') == host)
+        for values in series:
+            metric.remove(*values)
+
+
+TRANSFORM_SECONDS = Histogram(
+    'mtquery_transform_seconds', 'Time spent reshaping router replies.', ['step'],
+    buckets=(.0001, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1))
+
+BACKUP_SECONDS = Histogram(
+    'mtquery_backup_seconds', 'Duration of config backups.', ['host', 'result'],
+    buckets=(.5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+BACKUP_BYTES = Gauge(
+    'mtquery_backup_bytes', 'Size of the latest config export.', ['host'])
+LEADER = Gauge(
+    'mtquery_leader', 'Whether this worker process runs the scheduled backups and polls.')
+SCHEDULER_LAG_SECONDS = Histogram(
+    'mtquery_scheduler_lag_seconds', 'Delay between the scheduled and the actual start of a background job.',
+    ['job'], buckets=(.01, .05, .1, .5, 1, 5, 10, 30, 60))
+
+HTTP_IN_FLIGHT = Gauge(
+    'mtquery_http_requests_in_flight', 'Requests being handled, including open streams.', ['route'])
+HTTP_REQUEST_SECONDS = Histogram(
+    'mtquery_http_request_seconds', 'Time to handle a request, until the last byte of a stream.',
+    ['route', 'method', 'status'])
+
+
+# Time a function with a label of TRANSFORM_SECONDS
+def timed(step):
+    return TRANSFORM_SECONDS.labels(step).time()
+
+
+# Record the scheduler lag of every submitted job, labelled by the job kind (the part after the host)
+def watch_scheduler(scheduler):
+    def submitted(event):
+        now = dt.datetime.now(dt.timezone.utc)
+        job = event.job_id.rsplit('-', 1)[-1]
+        for run_time in event.scheduled_run_times:
+            SCHEDULER_LAG_SECONDS.labels(job).observe(max((now - run_time).total_seconds(), 0))
+
+    scheduler.add_listener(submitted, EVENT_JOB_SUBMITTED)
+
+
+class MetricsMiddleware:
+
+    def __init__(self, app):
+        self.app = app
+
+    # Label by route template, request paths carry host names
+    def _route(self, scope):
+        for route in scope['app'].routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route.path
+        return 'unmatched'
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        route = self._route(scope)
+        status = 500
+
+        async def send_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        started = time.perf_counter()
+        with HTTP_IN_FLIGHT.labels(route).track_inprogress():
+            try:
+                await self.app(scope, receive, send_status)
+            finally:
+                HTTP_REQUEST_SECONDS.labels(route, scope['method'], str(status)).observe(
+                    time.perf_counter() - started)
@@ -0,0 +1,133 @@
+# Copyright 2024 Comcast Cable Communications Management, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+from librouteros.exceptions import ConnectionClosed, FatalError, MultiTrapError, TrapError
+
+"""This file is used to pool RouterOS API sessions so that requests can reuse a login instead of
+opening a new one for every command."""
+
+
+class PoolExhausted(Exception):
+    """Raised when no connection for a host became available in time."""
+
+
+class ConnectionPool:
+
+    def __init__(self, connect, max_size=4, idle_timeout=300, keepalive=30, borrow_timeout=30):
+        # connect is awaited with a host and must return a logged in AsyncApi session
+        self._connect = connect
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.borrow_timeout = borrow_timeout
+        self._idle = {}
+        self._slots = {}
+
+    def _host_slots(self, host):
+        if host not in self._slots:
+            self._slots[host] = asyncio.Semaphore(self.max_size)
+            self._idle[host] = deque()
+        return self._slots[host]
+
+    # Return an idle connection for the host, dropping dead ones on the way
+    async def _take_idle(self, host):
+        while self._idle[host]:
+            connection, last_used = self._idle[host].pop()
+            if connection.closed:
+                continue
+            if time.monotonic() - last_used > self.keepalive and not await self._is_alive(connection):
+                self._close(connection)
+                continue
+            return connection
+        return None
+
+    async def _is_alive(self, connection):
+        try:
+            await asyncio.wait_for(connection('/system/identity/print'), self.borrow_timeout)
+            return True
+        except (ConnectionClosed, FatalError, OSError, asyncio.TimeoutError):
+            return False
+
+    @staticmethod
+    def _close(connection):
+        try:
+            connection.close()
+        except OSError as e:
+            logging.debug(f"closing pooled connection failed with {str(e)}")
+
+    @asynccontextmanager
+    async def connection(self, host):
+        slots = self._host_slots(host)
+        try:
+            await asyncio.wait_for(slots.acquire(), self.borrow_timeout)
+        except asyncio.TimeoutError:
+            raise PoolExhausted(f"No connection to {host} available after {self.borrow_timeout}s")
+        try:
+            self.evict_idle()
+            connection = await self._take_idle(host) or await self._connect(host)
+            try:
+                yield connection
+            except (TrapError, MultiTrapError):
+                # the router refused a command, the session itself is fine
+                self._put_back(host, connection)
+                raise
+            except BaseException:
+                # broken, cancelled or abandoned mid-reply, never hand such a session back to the pool
+                self._close(connection)
+                raise
+            self._put_back(host, connection)
+        finally:
+            slots.release()
+
+    def _put_back(self, host, connection):
+        idle = self._idle.get(host)
+        if connection.closed:
+            return
+        if idle is None:
+            # the host was forgotten while the session was borrowed
+            self._close(connection)
+        else:
+            idle.append((connection, time.monotonic()))
+
+    # Close the idle sessions of a host and drop its entries
+    def forget(self, host):
+        self._slots.pop(host, None)
+        for connection, _ in self._idle.pop(host, ()):
+            self._close(connection)
+
+    # Close every connection that has been idle for longer than idle_timeout
+    def evict_idle(self):
+        now = time.monotonic()
+        expired = []
+        for host, idle in self._idle.items():
+            expired.extend(item[0] for item in idle if now - item[1] > self.idle_timeout)
+            self._idle[host] = deque(item for item in idle if now - item[1] <= self.idle_timeout)
+        for connection in expired:
+            self._close(connection)
+        return len(expired)
+
+    def close(self):
+        for host, idle in self._idle.items():
+            for connection, _ in idle:
+                self._close(connection)
+            self._idle[host] = deque()
@@ -0,0 +1,116 @@
+# Copyright 2024 Comcast Cable Communications Management, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+"""This file is used to share router replies between the worker processes of a deployment.
+Replies are kept in a local SQLite database next to the leader lock, so a reply loaded by one worker, or by
+the leader's poller or follower, is served by every worker without asking the router again. SQLite is only
+used from one thread per process, so a locked database never blocks the event loop."""
+
+
+# Compact records are stored in the form the router sent them
+def row_default(obj):
+    if hasattr(obj, 'as_row'):
+        return obj.as_row()
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+class SharedStore:
+
+    def __init__(self, path, timeout=1):
+        self.path = path
+        self.timeout = timeout
+        self._db = None
+        self._executor = None
+
+    # Run a method of the store on its thread, calls are run in the order they are made
+    def run(self, method, *args):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='shared-store')
+        return asyncio.get_running_loop().run_in_executor(self._executor, method, *args)
+
+    # Opened on first use on the store's thread, so every forked worker has its own connection
+    def _connection(self):
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            # readers do not block the writer and the other way round
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.execute('CREATE TABLE IF NOT EXISTS replies (host TEXT, name TEXT, value BLOB, fetched_at REAL, '
+                       'PRIMARY KEY (host, name))')
+            self._db = db
+        return self._db
+
+    # Return a reply and its age in seconds, or None
+    def get(self, host, name):
+        return self.get_many(host, [name]).get(name)
+
+    # Return the replies found for the given names as (value, age in seconds) keyed by name
+    def get_many(self, host, names):
+        try:
+            placeholders = ', '.join('?' * len(names))
+            rows = self._connection().execute(
+                f"SELECT name, value, fetched_at FROM replies WHERE host = ? AND name IN ({placeholders})",
+                (host, *names)).fetchall()
+        except sqlite3.Error as e:
+            logging.warning(f"reading {', '.join(names)} of {host} from the shared store failed with {str(e)}")
+            return {}
+        now = time.time()
+        return dict((name, ((orjson.loads(value) if orjson else json.loads(value)), max(now - fetched_at, 0)))
+                    for name, value, fetched_at in rows)
+
+    def put(self, host, name, value):
+        data = orjson.dumps(value, default=row_default) if orjson else json.dumps(value, default=row_default).encode()
+        try:
+            self._connection().execute('INSERT OR REPLACE INTO replies VALUES (?, ?, ?, ?)',
+                                       (host, name, data, time.time()))
+        except sqlite3.Error as e:
+            logging.warning(f"writing {name} of {host} to the shared store failed with {str(e)}")
+
+    def invalidate(self, host=None, name=None):
+        try:
+            self._connection().execute('DELETE FROM replies WHERE (? IS NULL OR host = ?) AND (? IS NULL OR name = ?)',
+                                       (host, host, name, name))
+        except sqlite3.Error as e:
+            logging.warning(f"clearing the shared store failed with {str(e)}")
+
+    def _close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    # Wait for pending writes and close the connection
+    def close(self):
+        if self._executor is None:
+            self._close()
+            return
+        self._executor.submit(self._close)
+        self._executor.shutdown(wait=True)
+        self._executor = None
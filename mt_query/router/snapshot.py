@@ -0,0 +1,119 @@
+# Copyright 2024 Comcast Cable Communications Management, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+
+import datetime as dt
+import logging
+import time
+from typing import NamedTuple
+
+from werkzeug.exceptions import HTTPException
+
+"""This file is used to keep the latest polled router data so that requests can be answered without
+waiting on the router. Snapshots are replaced as a whole and never modified after they are stored."""
+
+
+class Snapshot(NamedTuple):
+    host: str
+    version: int
+    data: dict
+    updated: float
+    error: str = None
+
+    def age(self):
+        return time.time() - self.updated
+
+
+class SnapshotStore:
+
+    def __init__(self):
+        self._snapshots = {}
+        # bumped on every change to any host, usable as a cheap change marker
+        self.generation = 0
+        # called with every newly stored snapshot
+        self.listeners = []
+
+    def get(self, host):
+        return self._snapshots.get(host)
+
+    def hosts(self):
+        return list(self._snapshots)
+
+    def update(self, host, data):
+        previous = self._snapshots.get(host)
+        self.generation += 1
+        snapshot = Snapshot(host, (previous.version if previous else 0) + 1, data, time.time())
+        self._snapshots[host] = snapshot
+        for listener in self.listeners:
+            try:
+                listener(snapshot)
+            except Exception as e:
+                logging.warning(f"snapshot listener failed with {str(e)}")
+        return snapshot
+
+    # Keep the last good data but record that the latest poll failed
+    def fail(self, host, error):
+        previous = self._snapshots.get(host)
+        if previous:
+            self._snapshots[host] = previous._replace(error=error)
+
+
+class Poller:
+
+    def __init__(self, router, store, hosts=None, interval=10, max_age=60):
+        self.router = router
+        self.store = store
+        self.hosts = list(hosts or [])
+        self.interval = interval
+        # snapshots older than this are not served, requests fall back to the router
+        self.max_age = max_age
+
+    def schedule(self, scheduler):
+        for host in self.hosts:
+            self.add(scheduler, host)
+
+    def add(self, scheduler, host):
+        scheduler.add_job(self.poll, 'interval', seconds=self.interval, args=[host], name=f"{host}-poll",
+                          id=f"{host}-poll", next_run_time=dt.datetime.now(dt.timezone.utc), coalesce=True,
+                          max_instances=1, replace_existing=True)
+
+    def remove(self, scheduler, host):
+        if scheduler.get_job(f"{host}-poll"):
+            scheduler.remove_job(f"{host}-poll")
+
+    async def poll(self, host):
+        try:
+            data = await self.router.cached_calls(list(self.router.aggregate), host, fresh=True)
+        except HTTPException as e:
+            logging.warning(f"polling {host} failed with {e.description}")
+            self.store.fail(host, e.description)
+            return None
+        except Exception as e:
+            logging.warning(f"polling {host} failed with {str(e)}")
+            self.store.fail(host, str(e))
+            return None
+        return self.store.update(host, data)
+
+    # Return the snapshot for a host if it holds every name and is recent enough
+    def lookup(self, host, names, max_age=None):
+        snapshot = self.store.get(host)
+        if snapshot is None or any(name not in snapshot.data for name in names):
+            return None
+        limit = self.max_age if max_age is None else min(max_age, self.max_age)
+        if snapshot.age() > limit:
+            return None
+        return snapshot
+
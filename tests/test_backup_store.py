@@ -0,0 +1,117 @@
+# Copyright 2024 Comcast Cable Communications Management, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import gzip
+import os
+
+import pytest
+
+from mt_query.router import backup_store
+from mt_query.router.backup_store import BackupStore
+
+"""Tests for storing config exports, in particular the retention that deletes old versions from disk."""
+
+
+def export(body):
+    return [b'# jan/02/2024 10:00:00 by RouterOS 7.14.3\n', f'/system identity\nset name={body}\n'.encode()]
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1700000000.0]
+    monkeypatch.setattr(backup_store.time, 'time', lambda: now[0])
+    return now
+
+
+def stored_objects(store, host):
+    return sorted(name for name in os.listdir(store._host_path(host, 'objects')) if not name.startswith('.'))
+
+
+def test_unchanged_export_is_not_stored_again(tmp_path, clock):
+    store = BackupStore(str(tmp_path))
+    first, changed = store.save_stream('r1', export('a'))
+    assert changed
+    clock[0] += 60
+    # only the header line differs
+    again, changed = store.save_stream('r1', [b'# jan/02/2024 10:01:00 by RouterOS 7.14.3\n', *export('a')[1:]])
+    assert not changed and again == first
+    assert len(store.versions('r1')) == 1
+    with gzip.open(store.object_path('r1', first['digest'])) as f:
+        assert f.read() == b''.join(export('a'))
+
+
+def test_keep_count_deletes_old_objects_and_diffs(tmp_path, clock):
+    store = BackupStore(str(tmp_path), keep_count=2)
+    versions = []
+    for body in 'abc':
+        clock[0] += 60
+        versions.append(store.save_stream('r1', export(body))[0])
+    diff = store.diff('r1', versions[1], versions[2])
+    assert os.path.exists(diff)
+    clock[0] += 60
+    versions.append(store.save_stream('r1', export('d'))[0])
+
+    assert store.versions('r1') == versions[2:]
+    assert stored_objects(store, 'r1') == sorted(f"{version['digest']}.rsc.gz" for version in versions[2:])
+    assert not os.path.exists(diff)
+
+
+def test_objects_of_reverted_configs_are_kept(tmp_path, clock):
+    store = BackupStore(str(tmp_path), keep_count=2)
+    for body in 'aba':
+        clock[0] += 60
+        store.save_stream('r1', export(body))
+    versions = store.versions('r1')
+    # the first version is dropped, but the latest one has the same content and still needs its object
+    assert len(versions) == 2 and versions[-1]['digest'] != versions[0]['digest']
+    assert os.path.exists(store.object_path('r1', versions[-1]['digest']))
+    assert len(stored_objects(store, 'r1')) == 2
+
+
+def test_keep_days_never_drops_the_latest_version(tmp_path, clock):
+    store = BackupStore(str(tmp_path), keep_days=1)
+    store.save_stream('r1', export('a'))
+    clock[0] += 2 * 86400
+    latest, _ = store.save_stream('r1', export('b'))
+    assert store.versions('r1') == [latest]
+
+    store = BackupStore(str(tmp_path), keep_count=0)
+    clock[0] += 60
+    latest, _ = store.save_stream('r1', export('c'))
+    assert store.versions('r1') == [latest]
+    assert stored_objects(store, 'r1') == [f"{latest['digest']}.rsc.gz"]
+
+
+def test_failed_export_leaves_nothing_behind(tmp_path, clock):
+    store = BackupStore(str(tmp_path))
+
+    def failing():
+        yield from export('a')
+        raise RuntimeError('exit status 1')
+
+    with pytest.raises(RuntimeError):
+        store.save_stream('r1', failing())
+    assert store.versions('r1') == []
+    assert os.listdir(store._host_path('r1', 'objects')) == []
+
+
+def test_index_changes_of_other_processes_are_seen(tmp_path, clock):
+    leader, worker = BackupStore(str(tmp_path)), BackupStore(str(tmp_path))
+    leader.save_stream('r1', export('a'))
+    assert len(worker.versions('r1')) == 1
+    clock[0] += 60
+    leader.save_stream('r1', export('b'))
+    assert len(worker.versions('r1')) == 2
@@ -0,0 +1,126 @@
+# Copyright 2024 Comcast Cable Communications Management, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import asyncio
+import gc
+import weakref
+
+import pytest
+from librouteros.exceptions import TrapError
+
+from benchmarks.fake_routeros import FakeRouterOS, make_tables
+from mt_query.router.cache import ResponseCache
+from mt_query.router.client import connect
+
+COMMANDS = {
+    'identity': '/system/identity/print',
+    'leases': '/ip/dhcp-server/lease/print',
+    'netwatch': '/tool/netwatch/print',
+    'missing': '/no/such/print',
+}
+
+"""Tests for the reply cache: one router call per entry however many requests wait for it."""
+
+
+# Run a test coroutine with a cache and a fetch function loading from a fake router with some latency
+def with_router(test, latency=0.05):
+    async def run():
+        router = FakeRouterOS(make_tables(leases=20, netwatch=5), latency)
+        server = await router.serve(('127.0.0.1',), 0)
+        connection = await connect(username='test', password='test', host='127.0.0.1',
+                                   port=server.sockets[0].getsockname()[1], timeout=5)
+
+        async def fetch(names):
+            replies = await asyncio.gather(*(connection(COMMANDS[name]) for name in names))
+            return dict(zip(names, replies))
+
+        try:
+            # a request left waiting on a load that is never completed fails instead of hanging
+            await asyncio.wait_for(test(ResponseCache(), fetch), 5)
+        finally:
+            connection.close()
+            server.close()
+            await server.wait_closed()
+        # everything but the login
+        return router.commands - router.logins
+
+    return asyncio.run(run())
+
+
+def test_concurrent_requests_share_one_router_call():
+    async def test(cache, fetch):
+        replies = await asyncio.gather(*(cache.get('r1', 'identity', fetch) for _ in range(20)))
+        assert all(reply == [{'name': 'bench-router'}] for reply in replies)
+        # answered from the cache until the entry expires
+        assert await cache.get('r1', 'identity', fetch) == replies[0]
+
+    assert with_router(test) == 1
+
+
+def test_overlapping_requests_load_every_name_once():
+    async def test(cache, fetch):
+        first, second = await asyncio.gather(cache.get_many('r1', ['identity', 'leases'], fetch),
+                                             cache.get_many('r1', ['leases', 'netwatch'], fetch))
+        assert first['leases'] is second['leases']
+        assert len(first['leases']) == 20 and len(second['netwatch']) == 5
+
+    assert with_router(test) == 3
+
+
+def test_max_age_zero_always_asks_the_router():
+    async def test(cache, fetch):
+        await cache.get('r1', 'identity', fetch)
+        await cache.get('r1', 'identity', fetch, max_age=0)
+        await cache.get('r1', 'identity', fetch, max_age=0)
+        await cache.get('r1', 'identity', fetch)
+        # other hosts have their own entries
+        await cache.get('r2', 'identity', fetch)
+
+    assert with_router(test) == 4
+
+
+def test_failed_loads_reach_every_request_and_are_not_cached():
+    async def test(cache, fetch):
+        replies = await asyncio.gather(*(cache.get('r1', 'missing', fetch) for _ in range(5)), return_exceptions=True)
+        assert all(isinstance(reply, TrapError) for reply in replies)
+        with pytest.raises(TrapError):
+            await cache.get('r1', 'missing', fetch)
+
+    assert with_router(test) == 2
+
+
+def test_running_loads_survive_garbage_collection():
+    async def run():
+        cache = ResponseCache()
+        events = []
+
+        async def fetch(names):
+            # only the load itself refers to the event, like a reply being read from a session
+            event = asyncio.Event()
+            events.append(weakref.ref(event))
+            await event.wait()
+            return {'identity': 'r1'}
+
+        request = asyncio.ensure_future(cache.get('r1', 'identity', fetch))
+        while not events:
+            await asyncio.sleep(0)
+        gc.collect()
+        event = events[0]()
+        assert event is not None
+        event.set()
+        return await asyncio.wait_for(request, 1)
+
+    assert asyncio.run(run()) == 'r1'
@@ -0,0 +1,123 @@
+# Copyright 2024 Comcast Cable Communications Management, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import asyncio
+
+import pytest
+
+from benchmarks.fake_routeros import FakeRouterOS
+from mt_query.router.capability import CapabilityIndex
+from mt_query.router.client import connect
+from mt_query.router.common import ip_to_int
+
+"""Tests for matching leases to capabilities, locally and through the query words sent to the router."""
+
+PREFIXES = ('192.168.1', '192.168.10', '192.168.100', '192.168.101', '10.0.0', '172.16.0', '172.16.1')
+
+MULTI_PREFIX_MAP = [
+    {'name': 'SRV', 'base_ip': '192.168.10', 'start': 1, 'end': 50},
+    {'name': 'PWR', 'base_ip': ['192.168.100', '192.168.101'], 'start': 10, 'end': 20},
+    {'name': 'IRR', 'base_ip': '192.168.100', 'start': 15, 'end': 30},
+]
+
+CIDR_MAP = [
+    {'name': 'LAB', 'cidr': ['10.0.0.0/30', '172.16.0.128/25']},
+    {'name': 'SRV', 'base_ip': '192.168.100', 'start': 250, 'end': 255},
+    {'name': 'DUT', 'cidr': '172.16.1.0/24'},
+]
+
+
+def lease_rows():
+    addresses = [f'{prefix}.{host}' for prefix in PREFIXES for host in range(256)]
+    return [{'.id': f'*{i + 1:X}', 'address': address} for i, address in enumerate(addresses)]
+
+
+def test_overlapping_capabilities_share_addresses():
+    index = CapabilityIndex(MULTI_PREFIX_MAP)
+    assert index.lookup('192.168.100.12') == (1,)
+    assert index.lookup('192.168.100.15') == (1, 2)
+    assert index.lookup('192.168.100.20') == (1, 2)
+    assert index.lookup('192.168.100.21') == (2,)
+    assert index.lookup('192.168.101.15') == (1,)
+    # adjacent and overlapping ranges are sent to the router as one
+    assert (ip_to_int('192.168.100.10'), ip_to_int('192.168.100.30')) in index.ranges()
+
+
+def test_prefix_matches_whole_octets():
+    index = CapabilityIndex(MULTI_PREFIX_MAP)
+    assert index.lookup('192.168.10.5') == (0,)
+    assert index.lookup('192.168.100.5') == ()
+    assert index.lookup('192.168.10.51') == ()
+    assert index.lookup('192.168.1.10') == ()
+
+
+def test_cidr_capabilities():
+    index = CapabilityIndex(CIDR_MAP)
+    assert index.lookup('10.0.0.0') == (0,) and index.lookup('10.0.0.3') == (0,)
+    assert index.lookup('10.0.0.4') == ()
+    assert index.lookup('172.16.0.127') == () and index.lookup('172.16.0.255') == (0,)
+    assert index.lookup('172.16.1.0') == (2,)
+    assert index.lookup('192.168.100.255') == (1,)
+
+
+def test_lookup_of_invalid_addresses():
+    index = CapabilityIndex(MULTI_PREFIX_MAP)
+    assert index.lookup('') == ()
+    assert index.lookup('not an address') == ()
+    assert index.lookup('192.168.10.5') == index.lookup(ip_to_int('192.168.10.5'))
+
+
+def test_invalid_capability_maps():
+    with pytest.raises(ValueError):
+        CapabilityIndex([{'base_ip': '192.168.100', 'start': 1, 'end': 2}])
+    with pytest.raises(ValueError):
+        CapabilityIndex([{'name': 'SRV', 'base_ip': '192.168', 'start': 1, 'end': 2}])
+    assert CapabilityIndex([]).address_query() == ()
+
+
+# Return the addresses the fake router sends back for a lease print filtered by the index's query words
+def filtered_addresses(index, rows):
+    async def fetch():
+        router = FakeRouterOS({'/ip/dhcp-server/lease/print': rows})
+        server = await router.serve(('127.0.0.1',), 0)
+        connection = await connect(username='test', password='test', host='127.0.0.1',
+                                   port=server.sockets[0].getsockname()[1], timeout=5)
+        try:
+            return await connection('/ip/dhcp-server/lease/print', *index.address_query())
+        finally:
+            connection.close()
+            server.close()
+            await server.wait_closed()
+
+    return set(row['address'] for row in asyncio.run(fetch()))
+
+
+def test_multi_prefix_query_matches_local_lookup():
+    index = CapabilityIndex(MULTI_PREFIX_MAP)
+    rows = lease_rows()
+    expected = set(row['address'] for row in rows if index.lookup(row['address']))
+    assert filtered_addresses(index, rows) == expected
+    assert '192.168.10.50' in expected and '192.168.100.30' in expected and '192.168.101.20' in expected
+    assert '192.168.100.5' not in expected and '192.168.1.10' not in expected
+
+
+def test_cidr_query_matches_local_lookup():
+    index = CapabilityIndex(CIDR_MAP)
+    rows = lease_rows()
+    expected = set(row['address'] for row in rows if index.lookup(row['address']))
+    assert filtered_addresses(index, rows) == expected
+    assert set(f'10.0.0.{host}' for host in range(4)) < expected and '10.0.0.4' not in expected
+    assert '172.16.0.127' not in expected and '172.16.0.128' in expected and '172.16.1.255' in expected
@@ -0,0 +1,103 @@
+# Copyright 2024 Comcast Cable Communications Management, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import asyncio
+
+from benchmarks.fake_routeros import FakeRouterOS, make_tables
+from mt_query.router.cache import ResponseCache
+from mt_query.router.client import connect
+from mt_query.router.follow import FollowTable, Follower
+
+"""Tests for keeping router tables current from listen subscriptions."""
+
+LEASES = '/ip/dhcp-server/lease'
+
+
+def test_changes_before_the_load_are_applied_on_top_of_it():
+    table = FollowTable()
+    assert table.apply({'.id': '*1', 'address': '10.0.0.1', 'status': 'waiting'}) is None
+    assert table.apply({'.id': '*2', '.dead': True}) is None
+    assert not table.synced and table.list() == []
+
+    table.load([{'.id': '*1', 'address': '10.0.0.1', 'status': 'bound'},
+                {'.id': '*2', 'address': '10.0.0.2', 'status': 'bound'}])
+    assert table.synced
+    assert table.list() == [{'.id': '*1', 'address': '10.0.0.1', 'status': 'waiting'}]
+
+
+def test_dead_rows_are_removed():
+    table = FollowTable()
+    table.load([{'.id': '*1', 'address': '10.0.0.1'}, {'.id': '*2', 'address': '10.0.0.2'}])
+    version = table.version
+    assert table.apply({'.id': '*1', '.dead': True}) == ({'.id': '*1', 'address': '10.0.0.1'}, None)
+    assert table.list() == [{'.id': '*2', 'address': '10.0.0.2'}]
+    # removing an unknown row changes nothing
+    assert table.apply({'.id': '*9', '.dead': True}) is None
+    assert table.version == version + 1
+
+
+def test_reset_drops_held_back_changes():
+    table = FollowTable()
+    table.load([{'.id': '*1', 'status': 'bound'}])
+    table.reset()
+    table.apply({'.id': '*1', 'status': 'waiting'})
+    table.reset()
+    table.load([{'.id': '*1', 'status': 'bound'}])
+    assert table.list() == [{'.id': '*1', 'status': 'bound'}]
+
+
+class FakeRouter:
+
+    def __init__(self, port):
+        self.port = port
+        self.cache = ResponseCache()
+
+    async def login(self, host):
+        return await connect(username='test', password='test', host=host, port=self.port, timeout=5)
+
+
+def test_follower_keeps_changes_made_while_the_print_is_answered():
+    async def run():
+        # prints are answered late, with the rows as they were when the print arrived
+        router = FakeRouterOS(make_tables(leases=3, netwatch=2), latency=0.2)
+        server = await router.serve(('127.0.0.1',), 0)
+        follower = Follower(FakeRouter(server.sockets[0].getsockname()[1]), hosts=['127.0.0.1'])
+        table = follower.tables['127.0.0.1']['leases']
+        follower.start()
+        try:
+            while router.commands < 4:
+                await asyncio.sleep(0.01)
+            assert len(router.listens) == 2 and not table.synced
+            await router.change(LEASES, {'.id': '*1', 'status': 'waiting'})
+            await router.change(LEASES, {'.id': '*2', '.dead': 'true'})
+            await router.change(LEASES, {'.id': '*A', 'address': '192.168.100.10', 'status': 'bound'})
+            while not table.synced:
+                await asyncio.sleep(0.01)
+            rows = dict((row['.id'], row) for row in table.list())
+            assert sorted(rows) == ['*1', '*3', '*A']
+            assert rows['*1']['status'] == 'waiting' and rows['*1']['address'] == '192.168.100.1'
+
+            # and after the load
+            await router.change(LEASES, {'.id': '*3', '.dead': 'true'})
+            while '*3' in dict((row['.id'], row) for row in table.list()):
+                await asyncio.sleep(0.01)
+            assert follower.lookup('127.0.0.1', ['leases'])['leases'] == table.list()
+        finally:
+            follower.stop()
+            server.close()
+            await server.wait_closed()
+
+    asyncio.run(asyncio.wait_for(run(), 5))
@@ -15,7 +15,16 @@
 # SPDX-License-Identifier: Apache-2.0
 
 
-from app import application
+import os
+
+import uvicorn
+
+from app import app
+
+"""ASGI entry point for running the service in several worker processes, e.g.
+gunicorn -k uvicorn.workers.UvicornWorker -w 4 -b 0.0.0.0:9647 wsgi:application"""
+
+application = app
 
 if __name__ == "__main__":
-    application.run()
\ No newline at end of file
+    uvicorn.run("wsgi:application", host="0.0.0.0", port=9647, workers=int(os.environ.get('WEB_CONCURRENCY', 1)))